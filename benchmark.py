@@ -0,0 +1,230 @@
+"""
+Benchmarks of the processing stages on synthetic TreeMaker-like events.
+Runs fully offline; results are dumped to json so they can be compared
+across commits:
+
+    python benchmark.py
+    python benchmark.py --compare benchmarks/bench_<commit>.json
+"""
+import os, os.path as osp, time, json, argparse, subprocess, tempfile
+import numpy as np
+
+from dataset import (
+    JaggedArray, EventChunk, CutFlowColumn, METFILTERS, AK15_BRANCHES,
+    preselection, preselection_chunk, get_subl, get_subl_chunk,
+    part_flavor, part_flavor_chunk, select_truth_chunk,
+    )
+from combine_hists import combine_ds, combine_npzs, make_mt_histogram, score_chunks, BDT_FEATURES
+
+
+def synthetic_arrays(n_events, seed=1001):
+    """
+    Generates the branches of n_events synthetic events, with jet, GenParticle
+    and constituent multiplicities roughly like TreeMaker signal/QCD events.
+    Jagged branches are JaggedArrays, per-event branches flat arrays.
+    """
+    rng = np.random.default_rng(seed)
+    arrays = {}
+
+    def p4(prefix, counts, pt_scale, pt_min, mass_max):
+        n = counts.sum()
+        # Jets are pt-ordered within an event
+        parents = np.repeat(np.arange(n_events), counts)
+        pt = (rng.exponential(pt_scale, n) + pt_min).astype(np.float32)
+        pt = pt[np.lexsort((-pt, parents))]
+        eta = rng.normal(0., 1.4, n).astype(np.float32)
+        phi = rng.uniform(-np.pi, np.pi, n).astype(np.float32)
+        mass = rng.uniform(0., mass_max, n)
+        energy = np.sqrt((pt*np.cosh(eta))**2 + mass**2).astype(np.float32)
+        for var, values in zip(['fPt', 'fEta', 'fPhi', 'fE'], [pt, eta, phi, energy]):
+            arrays[f'{prefix}.fCoordinates.{var}'.encode()] = JaggedArray.from_counts(values, counts)
+
+    n_ak15 = rng.poisson(2.5, n_events)
+    p4('JetsAK15', n_ak15, 250., 150., 200.)
+    n = n_ak15.sum()
+    for key, branch in AK15_BRANCHES.items():
+        if key.startswith('ecf'):
+            # A few percent negative values, like failed ECF calculations
+            values = np.where(rng.random(n) < .03, -1., rng.uniform(0., 1., n))
+        elif key == 'multiplicity':
+            values = rng.poisson(60, n)
+        else:
+            values = rng.uniform(0., 1., n) * (200. if key == 'sdm' else 1.)
+        dtype = np.int32 if key == 'multiplicity' else np.float32
+        arrays[branch] = JaggedArray.from_counts(values.astype(dtype), n_ak15)
+
+    p4('JetsAK8', rng.poisson(2.5, n_events), 300., 200., 150.)
+
+    n_ak4 = rng.poisson(8, n_events)
+    p4('Jets', n_ak4, 60., 30., 30.)
+    arrays[b'Jets_partonFlavor'] = JaggedArray.from_counts(
+        rng.choice([0, 1, 2, 3, 4, 5, 21], n_ak4.sum()).astype(np.int32), n_ak4
+        )
+
+    # GenParticles: a Z' and two dark quarks, followed by a soup of other particles
+    n_gen = rng.poisson(150, n_events) + 3
+    p4('GenParticles', n_gen, 20., 0., 5.)
+    starts = np.cumsum(n_gen) - n_gen
+    pdgid = rng.choice([1, 2, 3, 11, 13, 22, 211, -211, 4900111, 4900211], n_gen.sum())
+    status = rng.choice([1, 2, 23, 71], n_gen.sum())
+    pdgid[starts] = 4900023
+    pdgid[starts+1] = 4900101
+    pdgid[starts+2] = -4900101
+    status[starts] = 22
+    status[starts+1] = 71
+    status[starts+2] = 71
+    arrays[b'GenParticles_PdgId'] = JaggedArray.from_counts(pdgid.astype(np.int32), n_gen)
+    arrays[b'GenParticles_Status'] = JaggedArray.from_counts(status.astype(np.int32), n_gen)
+
+    n_constituents = rng.poisson(80*np.maximum(n_ak15, 1))
+    p4('JetsAK15_constituents', n_constituents, 5., 0., .2)
+    arrays[b'JetsAK15_constituentsOffsets'] = JaggedArray.from_counts(
+        (rng.random(n_ak15.sum()) * 80).astype(np.int32), n_ak15
+        )
+
+    arrays[b'MET'] = rng.exponential(150., n_events).astype(np.float32)
+    arrays[b'METPhi'] = rng.uniform(-np.pi, np.pi, n_events).astype(np.float32)
+    arrays[b'Muons'] = rng.poisson(.1, n_events).astype(np.int32)
+    arrays[b'Electrons'] = rng.poisson(.1, n_events).astype(np.int32)
+    for metfilter in METFILTERS:
+        arrays[metfilter] = (rng.random(n_events) > .005).astype(np.int32)
+    return arrays
+
+
+def to_events(arrays):
+    """
+    Converts synthetic arrays to the per-event dicts of uptools.iter_events
+    """
+    n_events = len(arrays[b'MET'])
+    return [
+        {
+            key: value.content[value.offsets[i]:value.offsets[i+1]] if isinstance(value, JaggedArray) else value[i]
+            for key, value in arrays.items()
+            }
+        for i in range(n_events)
+        ]
+
+
+def time_it(fn, repeat=3):
+    """Returns the fastest wall time of `repeat` calls of fn"""
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def train_model(arrays):
+    """Trains a small bdt on the synthetic events, for the end-to-end benchmark"""
+    import xgboost as xgb
+    from combine_hists import get_features
+    chunk = EventChunk(arrays)
+    chunk = chunk.select(preselection_chunk(chunk))
+    features = get_features(chunk)
+    X = np.stack([features[key] for key in BDT_FEATURES], axis=1)
+    y = (features['mt'] > np.median(features['mt'])).astype(int)
+    model = xgb.XGBClassifier(n_estimators=50, max_depth=4, random_state=1001)
+    model.fit(X, y)
+    return model
+
+
+def run_benchmarks(sizes, per_event_max=20000, chunksize=10000, n_npzs=100, repeat=3):
+    """
+    Times every stage at every input size. Per-event implementations are only
+    timed up to per_event_max events. Returns a dict stage -> {size: seconds}.
+    """
+    results = {}
+    def record(stage, size, seconds):
+        results.setdefault(stage, {})[str(size)] = seconds
+        print(f'{stage:<28} {size:>8} events  {seconds:9.4f}s  {size/seconds:12.0f} events/s')
+
+    model = train_model(synthetic_arrays(5000, seed=1))
+
+    for size in sizes:
+        arrays = synthetic_arrays(size)
+        chunk = EventChunk(arrays)
+        passes = preselection_chunk(chunk)
+        presel = chunk.select(passes)
+
+        record('preselection_chunk', size, time_it(lambda: preselection_chunk(EventChunk(arrays), CutFlowColumn()), repeat))
+        record('get_subl_chunk', size, time_it(lambda: get_subl_chunk(presel), repeat))
+        record('part_flavor_chunk', size, time_it(lambda: part_flavor_chunk(presel), repeat))
+        record('select_truth_chunk', size, time_it(lambda: select_truth_chunk(presel), repeat))
+
+        if size <= per_event_max:
+            events = to_events(arrays)
+            events_presel = [e for e, p in zip(events, passes) if p]
+            record('preselection', size, time_it(lambda: [preselection(e) for e in events], 1))
+            record('get_subl', size, time_it(lambda: [get_subl(e) for e in events_presel], 1))
+            record('part_flavor', size, time_it(lambda: [part_flavor(e) for e in events_presel], 1))
+            # Both versions must handle the same events (e.g. without AK4 jets) the same way
+            np.testing.assert_array_equal(
+                part_flavor_chunk(presel).partonFlovor, [part_flavor(e).partonFlovor for e in events_presel]
+                )
+
+        mt = np.random.default_rng(size).uniform(100., 700., size)
+        record('make_mt_histogram', size, time_it(lambda: make_mt_histogram('bench', mt), repeat))
+
+        # Merging per-file outputs, like the outputs of the postbdt jobs
+        rng = np.random.default_rng(size)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            npzs = []
+            for i in range(n_npzs):
+                n = size // n_npzs
+                npzs.append(osp.join(tmpdir, f'{i}.npz'))
+                np.savez(npzs[-1], score=rng.random(n), mt=rng.random(n), pt=rng.random(n), total=np.int64(10*n))
+            record('combine_ds', size, time_it(lambda: combine_ds(np.load(npz) for npz in npzs), repeat))
+            record('combine_npzs', size, time_it(lambda: combine_npzs(npzs), repeat))
+
+        def end_to_end():
+            chunks = (EventChunk({k: v[i:i+chunksize] for k, v in arrays.items()}) for i in range(0, size, chunksize))
+            score_chunks(chunks, model, 'synthetic')
+        record('get_scores', size, time_it(end_to_end, repeat))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=osp.dirname(osp.abspath(__file__))
+            ).decode().strip()
+    except Exception:
+        return 'unknown'
+
+
+def compare(results, reference):
+    """Prints the ratio of the timings in results over those in reference"""
+    print(f'Comparing to {reference["commit"]} (ratio new/old, <1 is faster):')
+    for stage, timings in results['results'].items():
+        for size, seconds in timings.items():
+            old = reference['results'].get(stage, {}).get(size)
+            if old: print(f'{stage:<28} {size:>8} events  {seconds/old:6.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-o', '--outfile', type=str, default=None)
+    parser.add_argument('--compare', type=str, default=None)
+    args = parser.parse_args()
+
+    commit = git_commit()
+    results = dict(
+        commit = commit,
+        date = time.strftime('%Y-%m-%d %H:%M:%S'),
+        numpy = np.__version__,
+        results = run_benchmarks(args.sizes, repeat=args.repeat),
+        )
+    outfile = args.outfile or f'benchmarks/bench_{commit}.json'
+    if osp.dirname(outfile) and not osp.isdir(osp.dirname(outfile)): os.makedirs(osp.dirname(outfile))
+    with open(outfile, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results saved to {outfile}')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
-import os, os.path as osp, uuid, multiprocessing, shutil, logging
-from time import strftime
+import os, os.path as osp, uuid, logging, glob, zipfile, tempfile, struct, time
+import concurrent.futures
 
 import numpy as np
 import xgboost as xgb
@@ -7,71 +7,351 @@ import seutils
 import uptools
 uptools.logger.setLevel(logging.WARNING)
 
-from dataset import preselection, get_subl, calculate_mt_rt, CutFlowColumn, part_flavor, Offset_Constituents, calculate_mass, calculate_mt, calc_dphi, calculate_massmet, calculate_massmetpz, calculate_massmetpzm
+from dataset import preselection, preselection_chunk, iter_chunks, iter_indexed_chunks, get_branches, get_subl, get_subl_chunk, calculate_kinematics, calculate_mt_rt, CutFlowColumn, part_flavor, Offset_Constituents, calculate_mass, calculate_mt, calc_dphi, calc_dr, calculate_massmet, calculate_massmetpz, calculate_massmetpzm
+from dataset import file_size, code_version, model_hash, Profile, ColumnBuffer, write_columns, read_columns, read_column_metadata
 
-def get_scores(rootfile, model):
+# Input features of the bdt, in the order the model was trained on
+BDT_FEATURES = [
+    'girth', 'axisminor', 'ecfM2b1', 'ecfD2b1', 'ecfC2b1',
+    'ecfN2b2', 'metdphi', 'ptD', 'multiplicity',
+    ]
+
+def get_features(chunk):
+    '''
+    Computes the bdt features and the histogram variables for an EventChunk of
+    events that pass the preselection. Returns a dict of columns, with the keys
+    as they are stored in the output npz.
+    '''
+    subl = get_subl_chunk(chunk, kinematics=('rt', 'metdphi', 'mt', 'massmet'))
+    d = {key: getattr(subl, key) for key in BDT_FEATURES}
+    d.update(
+        mt = subl.mt,
+        rt = subl.rt,
+        pt = subl.pt,
+        energy = subl.energy,
+        trig = chunk[b'JetsAK8.fCoordinates.fPt'].at(0),
+        dphi = subl.metdphi,
+        eta = subl.eta,
+        pz = subl.pz,
+        mass = subl.mass,
+        massmet = subl.massmet,
+        )
+    return d
+
+
+def get_scores(rootfile, model, remote_options=None, profile=None, dtype=np.float64, nthread=None, index=None):
     '''
     Worker function that reads a single rootfile and returns the
     bdt score, and a few event-level variables to be potentially used
     for histogramming.
     Only uses events that pass the preselection.
+
+    `model` can also be a dict or list of models; the features are then
+    computed once and every model gets its own score column (see score_columns).
+
+    The rootfile can be a remote url, in which case only the needed branches
+    are streamed; remote_options tune the read-ahead (see dataset.REMOTE_READ_OPTIONS).
+    If a dataset.Profile is passed, the time spent per stage is recorded in it.
+    The variables are returned with `dtype`; the bdt always gets float32
+    inputs (as xgboost converts to float32 internally), so the score does not
+    depend on it. nthread sets the number of inference threads.
+
+    If a dataset.PreselectionIndex is passed, only the entries passing the
+    preselection are read (the index is made on first use).
     '''
-    X = []
-    X_histogram = []
-    X_mass = []
-    X_allvar = []
-    cutflow = CutFlowColumn()
+    chunks, cutflow = read_chunks(rootfile, remote_options, index)
+    return score_chunks(chunks, model, rootfile, profile, dtype, nthread, cutflow)
+
+
+def read_chunks(rootfile, remote_options=None, index=None, input_rootfile=None):
+    '''
+    Returns the EventChunks get_scores needs from rootfile, and None. With a
+    dataset.PreselectionIndex, only the passing entries are read and the cut
+    flow from the index is returned instead of None.
+    If input_rootfile is given (e.g. a local copy of rootfile), it is read
+    instead; the index is still looked up by rootfile.
+    '''
+    if input_rootfile is None: input_rootfile = rootfile
+    if index is None:
+        return iter_chunks(input_rootfile, stages=['preselection', 'bdt', 'histogram'], remote_options=remote_options), None
+    entries, cutflow = index.load(rootfile, input_rootfile)
+    return iter_indexed_chunks(input_rootfile, entries, stages=['bdt', 'histogram'], remote_options=remote_options), cutflow
+
+
+def score_chunks(chunks, model, label='', profile=None, dtype=np.float64, nthread=None, cutflow=None):
+    '''
+    Does the work of get_scores on an iterable of EventChunks. If the chunks
+    are already preselected, pass their cut flow.
+    '''
+    if profile is None: profile = Profile(label)
+    features, cutflow = extract_features(chunks, label, profile, dtype, cutflow)
+    if features is None: return
+    X = bdt_inputs(features)
+    with profile.time('predict', len(X)):
+        scores = {column: predict_scores(m, X, nthread) for column, m in score_columns(model).items()}
+    return scores_dict(features, scores, cutflow)
+
+
+def extract_features(chunks, label='', profile=None, dtype=np.float64, cutflow=None):
+    '''
+    Applies the preselection to an iterable of EventChunks and computes the
+    features of the passing events. Returns the features as a dict of columns
+    (None if no event passes) and the CutFlowColumn.
+    If cutflow is passed, the chunks are taken to be preselected already.
+    '''
+    if profile is None: profile = Profile(label)
+    features = None
+    preselected = cutflow is not None
+    if not preselected: cutflow = CutFlowColumn()
     try:
-        for event in uptools.iter_events(rootfile):
-            cutflow.plus_one('total')
-            if not preselection(event, cutflow): continue
-            subl = get_subl(event)
-            subl.mt, subl.rt = calculate_mt_rt(subl, event[b'MET'], event[b'METPhi'])
-            subl.mass = calculate_mass(subl)
-            subl.massmet = calculate_massmet(subl, event[b'MET'], event[b'METPhi'])
-            trig = event[b'JetsAK8.fCoordinates.fPt'][0] 
-            subl.dphi = calc_dphi(subl.phi, event[b'METPhi'])
-            X.append([
-                subl.girth, subl.axisminor, subl.ecfM2b1, subl.ecfD2b1, subl.ecfC2b1,
-                subl.ecfN2b2, subl.metdphi, subl.ptD, subl.multiplicity,
-                ])
-            X_histogram.append([subl.mt, subl.rt, subl.pt, subl.energy])
-            X_allvar.append([
-                subl.girth, subl.axisminor, subl.ecfM2b1, subl.ecfD2b1, subl.ecfC2b1,
-                subl.ecfN2b2, subl.metdphi, subl.ptD, subl.multiplicity, trig, subl.dphi, subl.eta, subl.pz, subl.mass, subl.massmet,
-                ])
+        for chunk in profile.iterate('read', chunks):
+            if not preselected:
+                cutflow.plus('total', len(chunk))
+                with profile.time('preselection', len(chunk)) as counts:
+                    chunk = chunk.select(preselection_chunk(chunk, cutflow))
+                    counts['n_out'] = len(chunk)
+            if len(chunk) == 0: continue
+            with profile.time('features', len(chunk)):
+                chunk_features = get_features(chunk)
+                if features is None: features = ColumnBuffer(list(chunk_features), dtype)
+                features.extend(chunk_features)
     except IndexError:
-        print(f'Problem with {rootfile}; saving {cutflow["preselection"]} good entries')
+        print(f'Problem with {label}; saving {cutflow["preselection"]} good entries')
     except:
-        print(f'Error processing {rootfile}; Skipping')
-    if cutflow['preselection'] == 0:
-        print(f'0/{cutflow["total"]} events passed the preselection for {rootfile}')
-        return
-    # Get the bdt scores
-    score = model.predict_proba(np.array(X))[:,1]
-    # Prepare and dump to file
-    X_histogram = np.array(X_histogram)
-    X_allvar = np.array(X_allvar)
+        print(f'Error processing {label}; Skipping')
+    if not features:
+        print(f'0/{cutflow["total"]} events passed the preselection for {label}')
+        return None, cutflow
+    return features.freeze(), cutflow
+
+
+def bdt_inputs(features):
+    '''
+    The bdt input matrix for a dict of features
+    '''
+    return np.stack([features[key] for key in BDT_FEATURES], axis=1).astype(np.float32)
+
+
+def predict_scores(model, X, nthread=None):
+    '''
+    Returns the signal probability for every row of X: the same numbers as
+    model.predict_proba(X)[:,1], but predicted directly on the booster with
+    inplace_predict, which skips the DMatrix construction and the sklearn
+    bookkeeping. nthread sets the number of threads of the booster.
+    '''
+    if not hasattr(model, 'get_booster'):
+        return model.predict_proba(X)[:,1]
+    booster = model.get_booster()
+    if nthread is not None: booster.set_param('nthread', nthread)
+    if not hasattr(booster, 'inplace_predict'):
+        score = booster.predict(xgb.DMatrix(X, nthread=-1 if nthread is None else nthread))
+    else:
+        # predict_proba only uses the trees up to the best iteration, if there is one
+        try:
+            iteration_range = (0, model.best_iteration + 1)
+        except AttributeError:
+            iteration_range = (0, 0)
+        score = booster.inplace_predict(X, iteration_range=iteration_range)
+    return score[:,1] if score.ndim == 2 else score
+
+
+def score_columns(model):
+    '''
+    Returns a dict of score column -> model. A single model is stored as
+    'score'. For a dict of models {name: model}, every model is stored as
+    score_<name>, except the model named 'score', which is stored as 'score'
+    (the column the histograms cut on by default); for a list, the name is the basename of the model .json
+    (for models given as paths) or the index in the list.
+    Models given as paths to a .json are loaded.
+    '''
+    if isinstance(model, (list, tuple)):
+        model = {
+            osp.splitext(osp.basename(m))[0] if isinstance(m, str) else str(i) : m
+            for i, m in enumerate(model)
+            }
+    if not isinstance(model, dict):
+        return {'score' : load_model(model)}
+    return {
+        'score' if name == 'score' else f'score_{name}' : load_model(m)
+        for name, m in model.items()
+        }
+
+
+def load_model(model):
+    '''Loads a model given as a path to a .json; loaded models are returned as is'''
+    if not isinstance(model, str): return model
+    loaded = xgb.XGBClassifier()
+    loaded.load_model(model)
+    return loaded
+
+
+def scores_dict(features, scores, cutflow):
+    '''
+    Puts the score columns, features and cut flow counts together in the output
+    format of get_scores
+    '''
     return dict(
-        score=score,
-        **{key: X_histogram[:,index] for index, key in enumerate(['mt', 'rt', 'pt', 'energy'])},
-        **{key: X_allvar[:,index] for index, key in enumerate(['girth', 'axisminor', 'ecfM2b1', 'ecfD2b1', 'ecfC2b1', 'ecfN2b2', 'metphi', 'ptD', 'multiplicity', 'trig', 'dphi', 'eta', 'pz', 'mass', 'massmet'])},
+        **scores,
+        **{key: features[key] for key in [
+            'mt', 'rt', 'pt', 'energy',
+            'girth', 'axisminor', 'ecfM2b1', 'ecfD2b1', 'ecfC2b1', 'ecfN2b2',
+            ]},
+        # Stored under 'metphi' for backwards compatibility
+        metphi=features['metdphi'],
+        **{key: features[key] for key in [
+            'ptD', 'multiplicity', 'trig', 'dphi', 'eta', 'pz', 'mass', 'massmet',
+            ]},
         **cutflow.counts
         )
 
 
+def iter_scores(rootfiles, model, batch_size=100000, nthread=None, remote_options=None, dtype=np.float64, profile=None, index=None, profiles=None):
+    '''
+    Like get_scores for many rootfiles, but the bdt is evaluated on batches of
+    events gathered across files: the features of files are collected until
+    there are at least batch_size events, which are then predicted in a single
+    call, and the scores are split back per file. Since the prediction of an
+    event does not depend on the other events in the batch, the scores are
+    identical to those of get_scores.
+
+    Yields (rootfile, d) in input order. If no event passed, d only holds the
+    cut flow counts (no 'mt' or other event columns), so that the events read
+    are still counted.
+    Items of rootfiles can also be (rootfile, input_rootfile) pairs, like the
+    ones dataset.Prefetcher yields; input_rootfile is read, rootfile is the label.
+    With a dataset.PreselectionIndex, only the passing entries are read.
+
+    Every file is timed in its own Profile, labelled with the rootfile; the
+    time of a batch prediction is shared out over the files by their number
+    of events. The records are merged into `profile`, and if a list is passed
+    as `profiles`, every per-file Profile is appended to it (dump them with
+    dataset.dump_profiles, the input of dataset.measure_rates).
+    '''
+    if profile is None: profile = Profile()
+    models = score_columns(model)
+    pending = []
+    n_pending = 0
 
+    def finish(file_profile):
+        profile.merge(file_profile)
+        if profiles is not None: profiles.append(file_profile)
 
+    def flush():
+        inputs = [bdt_inputs(features) for _, features, _, _ in pending if features is not None]
+        X = np.concatenate(inputs) if inputs else np.zeros((0, len(BDT_FEATURES)), np.float32)
+        t0 = time.perf_counter()
+        scores = {
+            column : predict_scores(m, X, nthread) if len(X) else np.zeros(0, np.float32)
+            for column, m in models.items()
+            }
+        seconds = time.perf_counter() - t0
+        i = 0
+        for rootfile, features, cutflow, file_profile in pending:
+            n = 0 if features is None else len(features['pt'])
+            file_profile.add('predict', seconds * n / len(X) if len(X) else 0., n, n)
+            finish(file_profile)
+            if features is None:
+                yield rootfile, dict(cutflow.counts)
+                continue
+            yield rootfile, scores_dict(features, {c: score[i:i+n] for c, score in scores.items()}, cutflow)
+            i += n
 
-def dump_score_npz(rootfile, model, outfile):
+    for rootfile in rootfiles:
+        rootfile, input_rootfile = (rootfile, rootfile) if isinstance(rootfile, str) else rootfile
+        file_profile = Profile(rootfile)
+        chunks, cutflow = read_chunks(rootfile, remote_options, index, input_rootfile)
+        features, cutflow = extract_features(chunks, rootfile, file_profile, dtype, cutflow)
+        pending.append((rootfile, features, cutflow, file_profile))
+        if features is not None: n_pending += len(features['pt'])
+        if n_pending >= batch_size:
+            yield from flush()
+            pending = []
+            n_pending = 0
+    yield from flush()
+
+
+def dump_score_npz(rootfile, model, outfile, remote_options=None, cache=None, profile=False, columnar=False, dtype=np.float64, nthread=None, index=None):
     '''    
     Calculates score and dumps events that pass the preselection to a .npz file.
+    If columnar is True, the events are dumped to a column directory instead
+    (outfile without extension; see dataset.write_columns), so that single
+    columns can be memory-mapped without reading the others.
+    If a dataset.ResultCache is passed, the output is taken from the cache when
+    the input, model and code are unchanged.
+    If profile is True, the per-stage timing is dumped to <outfile>.profile.json.
+    If a dataset.PreselectionIndex is passed, only the passing entries are read.
     '''
-    d = get_scores(rootfile, model)
-    print(f'Dumping {len(d["score"])} events from {rootfile} to {outfile}')
-    outdir = osp.dirname(outfile)
-    if outdir and not osp.isdir(outdir): os.makedirs(outdir)
-    np.savez(outfile, **d)
+    if columnar: outfile = osp.splitext(outfile)[0]
+    if cache is not None:
+        key = cache.key(
+            rootfile, model=model_hash(model),
+            code=code_version(score_chunks, extract_features, get_features, preselection_chunk, get_subl_chunk, calculate_kinematics),
+            schema=get_branches('preselection', 'bdt', 'histogram'), dtype=np.dtype(dtype).str,
+            )
+        if cache.fetch(key, outfile, rootfile): return
+    timing = Profile(rootfile)
+    d = get_scores(rootfile, model, remote_options, timing, dtype, nthread, index)
+    with timing.time('save', len(d['mt'])):
+        save_scores(d, outfile, rootfile, model, columnar)
+    if cache is not None: cache.store(key, outfile)
+    if profile:
+        timing.report()
+        timing.dump(osp.splitext(outfile)[0] + '.profile.json')
+
+
+def save_scores(d, outfile, rootfile, model, columnar=False):
+    '''
+    Saves the output of get_scores to an .npz, or to a column directory if
+    columnar is True
+    '''
+    print(f'Dumping {len(d.get("mt", []))} events from {rootfile} to {outfile}')
+    if columnar:
+        write_columns(outfile, d, dict(input=rootfile, model=model_hash(model)))
+    else:
+        outdir = osp.dirname(outfile)
+        if outdir and not osp.isdir(outdir): os.makedirs(outdir)
+        np.savez(outfile, **d)
+
+
+# Per-rootfile provenance arrays of dump_scores_aggregated
+PROVENANCE_KEYS = ['rootfiles', 'rootfile_rows', 'rootfile_entries']
+
+def dump_scores_aggregated(scores, outfile, model, columnar=False):
+    '''
+    Writes the (rootfile, d) pairs of iter_scores for many rootfiles to a
+    single output, so that a job stages out one file instead of one per
+    rootfile. Cut flow counts are summed over the rootfiles.
+
+    The provenance is stored with one entry per input rootfile, in input
+    order: `rootfiles` (the path), `rootfile_rows` (the number of output rows
+    from the file; the rows of a file are consecutive) and `rootfile_entries`
+    (the number of entries read, i.e. the entry range [0, n) of the file).
+    These are concatenated correctly by combine_ds and combine_npzs, and
+    np.repeat(d['rootfiles'], d['rootfile_rows']) gives the source per row.
+
+    Rootfiles without passing events still count in the cut flow and the
+    provenance; if no event passed at all, the output only holds those.
+    Returns the number of rootfiles that had events passing the preselection.
+    '''
+    ds = []
+    rootfiles = []
+    rows = []
+    entries = []
+    for rootfile, d in scores:
+        rootfiles.append(rootfile)
+        rows.append(len(d['mt']) if 'mt' in d else 0)
+        entries.append(d.get('total', 0))
+        ds.append(d)
+    n_passed = sum(1 for n in rows if n)
+    if not n_passed: print(f'No events passed the preselection in {len(rootfiles)} rootfiles')
+    d = combine_ds(ds)
+    d.update(
+        rootfiles = np.array(rootfiles),
+        rootfile_rows = np.array(rows, dtype=np.int64),
+        rootfile_entries = np.array(entries, dtype=np.int64),
+        )
+    save_scores(d, outfile, f'{len(rootfiles)} rootfiles', model, columnar)
+    return n_passed
 
 
 def combine_ds(ds):
@@ -84,6 +364,7 @@ def combine_ds(ds):
     combined = {}
     for d in ds:
         for key, value in d.items():
+            value = np.asarray(value)
             if not key in combined: combined[key] = []
             if value.shape and len(value) == 0: continue
             combined[key].append(value)
@@ -96,11 +377,94 @@ def combine_ds(ds):
     return combined
 
 
-def combine_npzs(npzs):
+def read_npz_header(npz):
     """
-    Like combine_ds, but instead takes an iterable of npz files
+    Returns a dict key -> (shape, dtype) for all arrays in an npz file,
+    without reading any of the data
+    """
+    read_array_header = {
+        (1, 0): np.lib.format.read_array_header_1_0,
+        (2, 0): np.lib.format.read_array_header_2_0,
+        }
+    header = {}
+    with zipfile.ZipFile(npz) as zf:
+        for name in zf.namelist():
+            with zf.open(name) as fp:
+                version = np.lib.format.read_magic(fp)
+                shape, _, dtype = read_array_header[version](fp)
+            header[name[:-4] if name.endswith('.npy') else name] = (shape, dtype)
+    return header
+
+
+def combine_npzs(npzs, outfile=None):
+    """
+    Like combine_ds, but instead takes an iterable of npz files (or a directory
+    containing npz files).
+
+    Works in two passes: the first reads only the npz headers to determine the
+    output shapes and dtypes, and sums the scalar values. The second pass copies
+    the arrays file by file into their place in the output. If outfile is given,
+    the output is streamed straight into an (uncompressed) npz file, so at most
+    one array of one input file is in memory at any time. Otherwise the combined
+    dict is returned, with every output array allocated only once.
     """
-    return combine_ds((np.load(npz) for npz in npzs))
+    if isinstance(npzs, str) and osp.isdir(npzs):
+        npzs = sorted(glob.glob(osp.join(npzs, '*.npz')))
+    npzs = list(npzs)
+
+    # First pass: headers and scalars
+    scalars = {}
+    arrays = {} # key -> (npzs with non-empty array, shapes, dtypes)
+    for npz in npzs:
+        header = read_npz_header(npz)
+        scalar_keys = [k for k, (shape, _) in header.items() if len(shape) == 0]
+        if scalar_keys:
+            with np.load(npz) as f:
+                for key in scalar_keys:
+                    scalars[key] = scalars.get(key, 0) + f[key]
+        for key, (shape, dtype) in header.items():
+            if len(shape) == 0 or shape[0] == 0: continue
+            arrays.setdefault(key, ([], [], []))
+            arrays[key][0].append(npz)
+            arrays[key][1].append(shape)
+            arrays[key][2].append(dtype)
+    out_headers = {
+        key: ((sum(s[0] for s in shapes),) + shapes[0][1:], np.result_type(*dtypes))
+        for key, (_, shapes, dtypes) in arrays.items()
+        }
+
+    # Second pass: copy arrays
+    def iter_arrays(key):
+        for npz in arrays[key][0]:
+            with np.load(npz) as f:
+                yield f[key].astype(out_headers[key][1], copy=False)
+
+    if outfile is None:
+        combined = {}
+        for key, (shape, dtype) in out_headers.items():
+            combined[key] = np.empty(shape, dtype=dtype)
+            i = 0
+            for array in iter_arrays(key):
+                combined[key][i:i+len(array)] = array
+                i += len(array)
+        combined.update(scalars)
+        return combined
+
+    outdir = osp.dirname(outfile)
+    if outdir and not osp.isdir(outdir): os.makedirs(outdir)
+    with zipfile.ZipFile(outfile, 'w', allowZip64=True) as zf:
+        for key, (shape, dtype) in out_headers.items():
+            with zf.open(key + '.npy', 'w', force_zip64=True) as fp:
+                np.lib.format.write_array_header_1_0(fp, {
+                    'descr': np.lib.format.dtype_to_descr(dtype),
+                    'fortran_order': False,
+                    'shape': shape,
+                    })
+                for array in iter_arrays(key):
+                    fp.write(np.ascontiguousarray(array).tobytes())
+        for key, value in scalars.items():
+            with zf.open(key + '.npy', 'w') as fp:
+                np.lib.format.write_array(fp, np.asarray(value))
 
 
 def try_import_ROOT():
@@ -119,7 +483,7 @@ def combine_ds_with_weights(ds, weights):
     Combines several dicts into a single dict, with weights
     """
     if len(ds) != len(weights): raise ValueError('len ds != len weights')
-    counts = [ len(d['score']) for d in ds ]
+    counts = [ len(d['mt']) for d in ds ]
     optimal_counts = optimal_count(counts, weights)
 
     # Purely for debugging:
@@ -136,55 +500,335 @@ def shrink_dict(d, n):
     Slices all values that are arrays in d up to :n.
     Integer counts are reduced by the fraction n/len(d)
     """
-    len_d = len(d['score']) # Just pick an array key that is always there
+    len_d = len(d['mt']) # Just pick an array key that is always there
     frac = min(float(n/len_d), 1.)
     return { k : v[:n] if v.shape else frac*v for k, v in d.items()}
 
 
+def mmap_npz_array(npz, key):
+    """
+    Memory-maps a single array of an .npz file. np.savez stores arrays
+    uncompressed, so the array data is a contiguous block of the file;
+    compressed arrays are read instead.
+    """
+    read_array_header = {
+        (1, 0): np.lib.format.read_array_header_1_0,
+        (2, 0): np.lib.format.read_array_header_2_0,
+        }
+    with zipfile.ZipFile(npz) as zf:
+        info = zf.getinfo(key + '.npy')
+        if info.compress_type != zipfile.ZIP_STORED:
+            with zf.open(info) as fp:
+                return np.lib.format.read_array(fp)
+    with open(npz, 'rb') as fp:
+        # The local file header has its own length fields, see the zip specification
+        fp.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack('<HH', fp.read(4))
+        fp.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(fp)
+        shape, fortran_order, dtype = read_array_header[version](fp)
+        offset = fp.tell()
+    if dtype.hasobject or np.prod(shape) == 0:
+        with np.load(npz) as f:
+            return f[key]
+    return np.memmap(npz, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran_order else 'C')
+
+
+def list_outputs(sample):
+    """
+    Returns the output files of a sample: a path to an .npz or a column
+    directory (see dataset.write_columns), a directory containing those, or a
+    list of any of these.
+    """
+    if not isinstance(sample, str):
+        return [output for path in sample for output in list_outputs(path)]
+    if osp.isfile(osp.join(sample, 'metadata.json')) or not osp.isdir(sample):
+        return [sample]
+    return sorted(
+        glob.glob(osp.join(sample, '*.npz'))
+        + [osp.dirname(m) for m in glob.glob(osp.join(sample, '*', 'metadata.json'))]
+        )
+
+
+def read_output_header(output):
+    """
+    Returns the arrays (dict key -> (shape, dtype)) and the scalar values of
+    an .npz or column directory, reading only headers, metadata and scalars.
+    """
+    if osp.isdir(output):
+        metadata = read_column_metadata(output)
+        arrays = {
+            key: (tuple(column['shape']), np.dtype(column['dtype']))
+            for key, column in metadata['columns'].items()
+            }
+        return arrays, metadata['cutflow']
+    header = read_npz_header(output)
+    arrays = {key: value for key, value in header.items() if len(value[0])}
+    scalar_keys = [key for key in header if key not in arrays]
+    scalars = {}
+    if scalar_keys:
+        with np.load(output) as f:
+            scalars = {key: f[key][()] for key in scalar_keys}
+    return arrays, scalars
+
+
+def load_output_column(output, key):
+    """Memory-maps a single column of an .npz or column directory"""
+    if osp.isdir(output):
+        return read_columns(output, [key])[key]
+    return mmap_npz_array(output, key)
+
+
+def combine_samples_with_weights(samples, weights, outfile=None, seed=1001, columns=None):
+    """
+    Streaming version of combine_ds_with_weights for samples on disk. Every
+    sample is anything list_outputs takes.
+
+    The number of events per sample is read from the file headers (the
+    length of 'mt'), optimal_count gives the number of events to use per
+    sample, and a seeded random subsample of that size is drawn from every
+    sample (instead of the first n rows, which biases the result if the files
+    are ordered). The columns are memory-mapped one file at a time and only
+    the selected rows are copied, into preallocated output arrays. Scalar
+    values (cut flow counts) are scaled by the fraction of the sample used,
+    like in shrink_dict.
+
+    `columns` limits the output to these columns. If outfile is given, the
+    result is also written as a column directory.
+    """
+    if len(samples) != len(weights): raise ValueError('len samples != len weights')
+    rng = np.random.default_rng(seed)
+    samples = [list_outputs(sample) for sample in samples]
+    headers = [[read_output_header(output) for output in outputs] for outputs in samples]
+
+    counts = [sum(arrays['mt'][0][0] for arrays, _ in sample_headers if 'mt' in arrays) for sample_headers in headers]
+    optimal_counts = optimal_count(counts, weights)
+    print('Counts:')
+    for i, (count, opt_count) in enumerate(zip(counts, optimal_counts)):
+        print(f'{i} : {count:8} available, using {opt_count}')
+
+    # Output columns: the per-event arrays (same length as 'mt') in all files
+    # with events. The provenance arrays are per file, but can happen to have
+    # the same length as 'mt', so they are left out explicitly
+    dtypes = None
+    for sample_headers in headers:
+        for arrays, _ in sample_headers:
+            if 'mt' not in arrays: continue
+            n_rows = arrays['mt'][0][0]
+            file_dtypes = {
+                key: dtype for key, (shape, dtype) in arrays.items()
+                if len(shape) == 1 and shape[0] == n_rows and key not in PROVENANCE_KEYS
+                and (columns is None or key in columns)
+                }
+            if dtypes is None:
+                dtypes = file_dtypes
+            else:
+                dtypes = {key: np.result_type(dtype, file_dtypes[key]) for key, dtype in dtypes.items() if key in file_dtypes}
+    dtypes = dtypes or {}
+
+    n_out = int(sum(min(int(n), count) for n, count in zip(optimal_counts, counts)))
+    combined = {key: np.empty(n_out, dtype) for key, dtype in dtypes.items()}
+    scalars = {}
+    i_out = 0
+    for outputs, sample_headers, count, opt_count in zip(samples, headers, counts, optimal_counts):
+        n = min(int(opt_count), count)
+        frac = n / count if count else 0.
+        for _, output_scalars in sample_headers:
+            for key, value in output_scalars.items():
+                scalars[key] = scalars.get(key, 0) + frac*value
+        # Random rows of the sample, in file order, split per file
+        rows = np.sort(rng.choice(count, n, replace=False))
+        lengths = [arrays['mt'][0][0] if 'mt' in arrays else 0 for arrays, _ in sample_headers]
+        bounds = np.searchsorted(rows, np.cumsum([0] + lengths))
+        offset = 0
+        for output, length, lo, hi in zip(outputs, lengths, bounds[:-1], bounds[1:]):
+            if hi > lo:
+                for key in combined:
+                    combined[key][i_out:i_out+hi-lo] = load_output_column(output, key)[rows[lo:hi] - offset]
+                i_out += hi - lo
+            offset += length
+    combined.update(scalars)
+    if outfile is not None: write_columns(outfile, combined)
+    return combined
+
+
 # Defauly mt binning
 MT_BINNING = [160.+8.*i for i in range(44)]
 # MT_BINNING = [8.*i for i in range(130)]
 
 
+class Histogram:
+    """
+    Numpy-backed 1D histogram with variable binning.
+
+    `values` and `sumw2` have nbins+2 entries: index 0 is the underflow and
+    index -1 the overflow, like the bin numbering of a ROOT TH1. Bins are
+    [low, high), also like ROOT.
+    """
+    def __init__(self, name, binning, values=None, sumw2=None, entries=0, title=None):
+        self.name = name
+        self.title = name if title is None else title
+        # Bin edges are stored as float32 by TH1F; use the same edges for the same bin assignment
+        self.binning = np.array(binning, dtype=np.float32).astype(np.float64)
+        self.values = np.zeros(self.nbins+2) if values is None else values
+        self.sumw2 = np.zeros(self.nbins+2) if sumw2 is None else sumw2
+        self.entries = entries
+
+    @property
+    def nbins(self):
+        return len(self.binning)-1
+
+    def fill(self, x, weights=None):
+        x = np.asarray(x)
+        index = np.searchsorted(self.binning, x, side='right')
+        self.values += np.bincount(index, weights=weights, minlength=self.nbins+2)
+        self.sumw2 += np.bincount(index, weights=None if weights is None else weights**2, minlength=self.nbins+2)
+        self.entries += x.shape[0]
+
+    def integral(self, overflow=True):
+        return self.values.sum() if overflow else self.values[1:-1].sum()
+
+    def scale(self, factor):
+        self.values *= factor
+        self.sumw2 *= factor**2
+
+    def normalize(self, normalization=1.):
+        """Scales such that the integral (including under/overflow) is `normalization`"""
+        integral = self.integral()
+        self.scale(normalization / integral if integral != 0. else 0.)
+
+    def copy(self):
+        return self.__class__(
+            self.name, self.binning, self.values.copy(), self.sumw2.copy(),
+            self.entries, self.title
+            )
+
+    def __add__(self, other):
+        if not np.array_equal(self.binning, other.binning):
+            raise ValueError('Cannot add histograms with different binning')
+        return self.__class__(
+            self.name, self.binning, self.values + other.values, self.sumw2 + other.sumw2,
+            self.entries + other.entries, self.title
+            )
+
+    def to_th1f(self, name=None, title=None):
+        """
+        Converts to a ROOT TH1F, e.g. for writing datacards
+        """
+        try_import_ROOT()
+        import ROOT
+        from array import array
+        if name is None: name = self.name.replace('.','p')
+        if title is None: title = self.title
+        h = ROOT.TH1F(name, title, self.nbins, array('f', self.binning))
+        ROOT.SetOwnership(h, False)
+        h.Sumw2()
+        for i in range(self.nbins+2):
+            h.SetBinContent(i, self.values[i])
+            h.SetBinError(i, np.sqrt(self.sumw2[i]))
+        h.SetEntries(self.entries)
+        return h
+
+
 def make_mt_histogram(name, mt, score=None, threshold=None, mt_binning=None, normalization=None):
     """
-    Dumps the mt array to a TH1F. If `score` and `threshold` are supplied, a
+    Histograms the mt array. If `score` and `threshold` are supplied, a
     cut score>threshold will be applied.
 
     Normalization refers to the normalization *before* applying the threshold!
     """
-    try_import_ROOT()
-    import ROOT
-    from array import array
     efficiency = 1.
     if threshold is not None:
         mt = mt[score > threshold]
         efficiency = (score > threshold).sum() / score.shape[0]
         # print(f'{name}: {efficiency=}')
-    binning = array('f', MT_BINNING if mt_binning is None else mt_binning)
-    h = ROOT.TH1F(name.replace('.','p'), name, len(binning)-1, binning)
-    ROOT.SetOwnership(h, False)
-    [ h.Fill(x) for x in mt ]
+    h = Histogram(name, MT_BINNING if mt_binning is None else mt_binning)
+    h.fill(mt)
     if normalization is not None:
-        integral = h.Integral(0, h.GetNbinsX()+1)
-        h.Scale(normalization*efficiency / integral if integral != 0. else 0.)
+        h.normalize(normalization*efficiency)
     return h
 
 
-def make_summed_histogram(name, ds, norms, threshold=None, mt_binning=None):
+def make_summed_histogram(name, ds, norms, threshold=None, mt_binning=None, score_key='score'):
+    """
+    Sums the mt histograms of several samples, cutting on d[score_key] > threshold.
+    """
     from operator import add
     from functools import reduce
     h = reduce(add, (
         make_mt_histogram(
-            str(uuid.uuid4()), d['mt'], d['score'],
+            str(uuid.uuid4()), d['mt'], d[score_key],
             threshold=threshold, normalization=norm, mt_binning=mt_binning
             )
         for d, norm in zip(ds, norms)
         ))
-    h.SetNameTitle(name, name)
+    h.name = name
+    h.title = name
     return h
 
 
+def make_mt_histograms_scan(name, mt, score, thresholds, mt_binning=None, normalization=None):
+    """
+    Like make_mt_histogram, but for many thresholds at once. Events are sorted
+    by score once, and a cumulative (score x mt) histogram gives the mt
+    histogram of score>threshold for every threshold.
+
+    Returns a list of Histograms (one per threshold) and an array of efficiencies.
+    """
+    binning = MT_BINNING if mt_binning is None else mt_binning
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    n = score.shape[0]
+    # NaN scores never pass a threshold, but do count in the efficiency
+    valid = ~np.isnan(score)
+    order = np.argsort(-score[valid], kind='stable')
+    mt_sorted = mt[valid][order]
+    score_sorted = score[valid][order]
+    # Number of events passing each threshold; the passing events are the first n_pass in mt_sorted
+    n_pass = np.searchsorted(-score_sorted, -thresholds, side='left')
+    # Split events in segments between consecutive n_pass values, histogram
+    # every segment, and cumulatively sum the segments
+    i_sorted = np.argsort(n_pass, kind='stable')
+    segment = np.searchsorted(n_pass[i_sorted], np.arange(len(mt_sorted)), side='right')
+    h = Histogram(name, binning)
+    nbins = h.nbins+2
+    mt_index = np.searchsorted(h.binning, mt_sorted, side='right')
+    keep = segment < len(thresholds)
+    counts = np.bincount(
+        segment[keep]*nbins + mt_index[keep], minlength=len(thresholds)*nbins
+        ).reshape(len(thresholds), nbins)
+    counts = np.cumsum(counts, axis=0)
+    # Back to the order of the thresholds as passed
+    counts_ordered = np.empty_like(counts)
+    counts_ordered[i_sorted] = counts
+
+    efficiencies = n_pass / n if n else np.zeros(len(thresholds))
+    hists = []
+    for threshold, values, n_pass_this in zip(thresholds, counts_ordered, n_pass):
+        h = Histogram(f'{name}_{threshold}', binning, values.astype(np.float64), values.astype(np.float64), n_pass_this)
+        if normalization is not None:
+            # normalization*efficiency/integral, with integral == n_pass
+            h.scale(normalization / n if n_pass_this else 0.)
+        hists.append(h)
+    return hists, efficiencies
+
+
+def make_summed_histograms_scan(name, ds, norms, thresholds, mt_binning=None, score_key='score'):
+    """
+    Like make_summed_histogram, but for many thresholds in a single pass.
+    Returns a list of summed Histograms (one per threshold) and an array of
+    efficiencies of shape (n_samples, n_thresholds).
+    """
+    summed = None
+    efficiencies = []
+    for d, norm in zip(ds, norms):
+        hists, eff = make_mt_histograms_scan(
+            name, d['mt'], d[score_key], thresholds, mt_binning=mt_binning, normalization=norm
+            )
+        efficiencies.append(eff)
+        summed = hists if summed is None else [a + b for a, b in zip(summed, hists)]
+    return summed, np.array(efficiencies)
+
+
 def optimal_count(counts, weights):
     """
     Given an array of counts and an array of desired weights (e.g. cross sections),
@@ -213,39 +857,78 @@ def optimal_count(counts, weights):
 
 # ________________________________________________________
 # For local multiprocessing running
-# Not recommended, way too slow
 
 def dump_score_npz_worker(input):
     '''    
     Like dump_score_npz but takes a single tuple as input.
-    To be used in dump_score_npzs_mp.
     '''
     dump_score_npz(*input)
 
-def dump_score_npzs_mp(model, rootfiles, outfile, n_threads=12, keep_tmp_files=False):
+
+# The model of a worker process, loaded once by init_score_worker
+_worker_model = None
+
+def init_score_worker(model_json):
+    '''
+    Initializer for the worker processes of dump_score_npzs_mp: loads the
+    model once per process, single-threaded since the processes already
+    occupy all cores.
+    '''
+    global _worker_model
+    _worker_model = xgb.XGBClassifier()
+    _worker_model.load_model(model_json)
+    _worker_model.set_params(n_jobs=1)
+
+def get_scores_worker(rootfile):
+    return get_scores(rootfile, _worker_model, nthread=1)
+
+
+def dump_score_npzs_mp(model, rootfiles, outfile, n_threads=12):
     '''
     Entrypoint to read a list of rootfiles, locally compute the BDT scores, and combine
     it all in a single .npz file.
-    Uses multiprocessing to speed things up.
+
+    `model` is the path to the model .json, or a loaded XGBClassifier.
+    Every worker process loads the model once. The largest files are scheduled
+    first, results come back in memory and are merged as they arrive: the
+    arrays are copied into a ColumnBuffer and the result is dropped, so only
+    the merged columns are kept in memory.
     '''
     print(f'Processing {len(rootfiles)} rootfiles to {outfile}')
-    tmpdir = strftime(f'TMP_%b%d_%H%M%S_{outfile}')
-    os.makedirs(tmpdir)
-    # Prepare input data
-    data = []
-    for rootfile in rootfiles:
-        data.append([ rootfile, model, osp.join(tmpdir, str(uuid.uuid4())+'.npz') ])
-    # Process data in multiprocessing pool
-    # Every thread will dump data into tmpdir/<unique id>.npz
-    pool = multiprocessing.Pool(n_threads)
-    pool.map(dump_score_npz_worker, data)
-    pool.close()
-    pool.join()
-    # Combine the tmpdir/<unique id>.npz --> outfile and remove tmp files
-    combine_npzs(tmpdir, outfile)
-    if not keep_tmp_files:
-        print(f'Removing {tmpdir}')
-        shutil.rmtree(tmpdir)
+    sizes = {rootfile: file_size(rootfile) for rootfile in rootfiles}
+    rootfiles = sorted(rootfiles, key=lambda f: -1 if sizes[f] is None else sizes[f], reverse=True)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if isinstance(model, str):
+            model_json = model
+        else:
+            model_json = osp.join(tmpdir, 'model.json')
+            model.save_model(model_json)
+        with concurrent.futures.ProcessPoolExecutor(
+            n_threads, initializer=init_score_worker, initargs=(model_json,)
+            ) as executor:
+            futures = {executor.submit(get_scores_worker, f): f for f in rootfiles}
+            columns = None
+            scalars = {}
+            for future in concurrent.futures.as_completed(futures):
+                rootfile = futures.pop(future)
+                try:
+                    d = future.result()
+                except Exception as e:
+                    print(f'Failed for rootfile {rootfile}: {e}')
+                    continue
+                if d is None: continue
+                arrays = {key: value for key, value in d.items() if np.ndim(value)}
+                if columns is None: columns = ColumnBuffer({key: value.dtype for key, value in arrays.items()})
+                columns.extend(arrays)
+                # Cut flow counts are summed
+                for key, value in d.items():
+                    if not np.ndim(value): scalars[key] = scalars.get(key, 0) + value
+                del d, arrays
+            combined = dict(columns.freeze() if columns is not None else {}, **scalars)
+    print(f'Dumping {len(combined.get("score", []))} events to {outfile}')
+    outdir = osp.dirname(outfile)
+    if outdir and not osp.isdir(outdir): os.makedirs(outdir)
+    np.savez(outfile, **combined)
 
 # ________________________________________________________
 # Some tests
@@ -258,6 +941,51 @@ def test_get_scores():
     import pprint
     pprint.pprint(d, sort_dicts=False)
 
+def test_get_scores_float32():
+    model = xgb.XGBClassifier()
+    model.load_model('/Users/klijnsma/work/svj/bdt/svjbdt_Aug02.json')
+    rootfile = 'TREEMAKER_genjetpt375_Jul21_mz250_mdark10_rinv0.337.root'
+    d64 = get_scores(rootfile, model)
+    d32 = get_scores(rootfile, model, dtype=np.float32)
+    np.testing.assert_array_equal(d64['score'], d32['score'])
+    np.testing.assert_array_equal(d64['mt'].astype(np.float32), d32['mt'])
+    assert d32['mt'].dtype == np.float32
+    print('Succeeded')
+
+def test_preselection_chunk():
+    rootfile = 'TREEMAKER_genjetpt375_Jul21_mz250_mdark10_rinv0.337.root'
+    cutflow_events = CutFlowColumn()
+    passes_events = np.array([preselection(e, cutflow_events) for e in uptools.iter_events(rootfile)])
+    cutflow_chunks = CutFlowColumn()
+    passes_chunks = np.concatenate([preselection_chunk(c, cutflow_chunks) for c in iter_chunks(rootfile)])
+    np.testing.assert_array_equal(passes_events, passes_chunks)
+    assert cutflow_events.counts == cutflow_chunks.counts
+    print('Succeeded')
+
+def test_preselection_chunk_boundary():
+    '''
+    Subleading jets exactly at the eta and rt cuts, on synthetic events (see
+    benchmark.py): the vectorized cuts have to round like the per-event ones
+    '''
+    from benchmark import synthetic_arrays, to_events
+    from dataset import EventChunk
+    arrays = synthetic_arrays(3000)
+    pt = arrays[b'JetsAK15.fCoordinates.fPt']
+    eta = arrays[b'JetsAK15.fCoordinates.fEta']
+    has_subl = np.flatnonzero(pt.counts >= 2)
+    subl = pt.offsets[has_subl] + 1
+    # Half at |eta| == 2.4, half at MET/pt == .21, i.e. float32 rt == 1.1
+    at_eta, at_rt = has_subl[::2], has_subl[1::2]
+    eta.content[subl[::2]] = np.where(np.arange(len(at_eta)) % 2, 2.4, -2.4).astype(np.float32)
+    arrays[b'MET'][at_rt] = (pt.content[subl[1::2]] * np.float32(.21)).astype(np.float32)
+    cutflow_events = CutFlowColumn()
+    passes_events = np.array([preselection(e, cutflow_events) for e in to_events(arrays)])
+    cutflow_chunk = CutFlowColumn()
+    passes_chunk = preselection_chunk(EventChunk(arrays), cutflow_chunk)
+    np.testing.assert_array_equal(passes_events, passes_chunk)
+    assert cutflow_events.counts == cutflow_chunk.counts
+    print('Succeeded')
+
 def test_dump_score_npz_worker():
     model = xgb.XGBClassifier()
     model.load_model('/Users/klijnsma/work/svj/bdt/svjbdt_Aug02.json')
@@ -299,6 +1027,284 @@ def test_optimal_count():
     print('Succeeded')
 
 
+def test_select_truth_chunk():
+    '''
+    Compares the vectorized truth matching with the per-event selection of the
+    original process_signal, on synthetic events (see benchmark.py)
+    '''
+    from benchmark import synthetic_arrays, to_events
+    from dataset import EventChunk, FourVectorArray, select_truth_chunk, calc_dr
+    rng = np.random.default_rng(1002)
+    arrays = synthetic_arrays(3000)
+    pdgid = arrays[b'GenParticles_PdgId']
+    status = arrays[b'GenParticles_Status'].content
+    eta = arrays[b'GenParticles.fCoordinates.fEta'].content
+    phi = arrays[b'GenParticles.fCoordinates.fPhi'].content
+    starts = pdgid.offsets[:-1]
+    # Events without a Z', with one or three dark quarks, and truth particles
+    # close to the subleading jet, so that every requirement cuts something
+    pdgid.content[starts[rng.random(len(starts)) < .05]] = 1
+    status[(starts+1)[rng.random(len(starts)) < .05]] = 23
+    extra = rng.random(len(pdgid.content)) < .002
+    pdgid.content[extra] = 4900101
+    status[extra] = 71
+    jet_eta = arrays[b'JetsAK15.fCoordinates.fEta']
+    jet_phi = arrays[b'JetsAK15.fCoordinates.fPhi']
+    close = np.flatnonzero((np.diff(jet_eta.offsets) >= 2) & (rng.random(len(starts)) < .5))
+    for i in range(3):
+        eta[starts[close]+i] = jet_eta.content[jet_eta.offsets[close]+1] + rng.normal(0., .8, len(close))
+        phi[starts[close]+i] = jet_phi.content[jet_phi.offsets[close]+1] + rng.normal(0., .8, len(close))
+
+    chunk = EventChunk(arrays)
+    presel = preselection_chunk(chunk)
+    cutflow_chunk = CutFlowColumn()
+    passes_chunk = select_truth_chunk(chunk.select(presel), cutflow_chunk)
+
+    cutflow_events = CutFlowColumn()
+    passes_events = []
+    for event in np.array(to_events(arrays), dtype=object)[presel]:
+        genparticles = FourVectorArray(
+            event[b'GenParticles.fCoordinates.fPt'],
+            event[b'GenParticles.fCoordinates.fEta'],
+            event[b'GenParticles.fCoordinates.fPhi'],
+            event[b'GenParticles.fCoordinates.fE'],
+            pdgid=event[b'GenParticles_PdgId'],
+            status=event[b'GenParticles_Status']
+            )
+        passes_events.append(False)
+        zprime = genparticles[genparticles.pdgid == 4900023]
+        if len(zprime) == 0: continue
+        cutflow_events.plus_one('zprime')
+        dark_quarks = genparticles[(np.abs(genparticles.pdgid) == 4900101) & (genparticles.status == 71)]
+        if len(dark_quarks) != 2: continue
+        cutflow_events.plus_one('darkquarks==2')
+        subl = get_subl(event)
+        if not all(calc_dr(subl.eta, subl.phi, obj.eta, obj.phi) < 1.5 for obj in [
+            zprime[0], dark_quarks[0], dark_quarks[1]
+            ]):
+            continue
+        cutflow_events.plus_one('truthdr<1.5')
+        passes_events[-1] = True
+
+    np.testing.assert_array_equal(passes_chunk, passes_events)
+    assert cutflow_chunk.counts == cutflow_events.counts
+    assert 0 < passes_chunk.sum() < len(passes_chunk)
+    print('Succeeded')
+
+
+def test_part_flavor_chunk():
+    '''
+    Compares match_dr and part_flavor_chunk with the per-event loop of
+    part_flavor on synthetic events, including events without AK4 jets
+    '''
+    from benchmark import synthetic_arrays, to_events
+    from dataset import EventChunk, JaggedArray, match_dr, part_flavor_chunk
+    rng = np.random.default_rng(1004)
+    arrays = synthetic_arrays(3000)
+    # Remove the AK4 jets of some events
+    no_jets = rng.random(len(arrays[b'MET'])) < .1
+    for branch in [
+        b'Jets.fCoordinates.fPt', b'Jets.fCoordinates.fEta', b'Jets.fCoordinates.fPhi',
+        b'Jets.fCoordinates.fE', b'Jets_partonFlavor',
+        ]:
+        jagged = arrays[branch]
+        arrays[branch] = JaggedArray.from_counts(
+            jagged.content[~no_jets[jagged.parents]], np.where(no_jets, 0, jagged.counts)
+            )
+    chunk = EventChunk(arrays)
+    presel = preselection_chunk(chunk)
+    chunk = chunk.select(presel)
+    events = np.array(to_events(arrays), dtype=object)[presel]
+    assert no_jets[presel].any()
+
+    subl = get_subl_chunk(chunk)
+    index, min_dr = match_dr(subl.eta, subl.phi, chunk[b'Jets.fCoordinates.fEta'], chunk[b'Jets.fCoordinates.fPhi'])
+    flavor = part_flavor_chunk(chunk, subl)
+    for i, event in enumerate(events):
+        flavor_event = part_flavor(event)
+        drs = calc_dr(event[b'Jets.fCoordinates.fEta'], event[b'Jets.fCoordinates.fPhi'], subl.eta[i], subl.phi[i])
+        assert index[i] == (np.argmin(drs) if len(drs) else -1)
+        if len(drs): np.testing.assert_allclose(min_dr[i], drs.min(), rtol=1e-5)
+        for key in ['pt', 'eta', 'phi', 'energy', 'partonFlovor']:
+            np.testing.assert_equal(getattr(flavor, key)[i], getattr(flavor_event, key))
+    print('Succeeded')
+
+
+def test_histograms_scan():
+    '''
+    Compares the histograms of make_summed_histograms_scan with calling
+    make_summed_histogram for every threshold, on synthetic events
+    '''
+    from benchmark import synthetic_arrays
+    from dataset import EventChunk
+    rng = np.random.default_rng(1003)
+    ds = []
+    for seed in [1, 2]:
+        chunk = EventChunk(synthetic_arrays(5000, seed))
+        chunk = chunk.select(preselection_chunk(chunk))
+        mt = get_features(chunk)['mt']
+        # Rounded scores for ties with the thresholds, and a few NaNs
+        score = np.round(rng.random(len(mt)), 2)
+        score[rng.random(len(mt)) < .01] = np.nan
+        ds.append(dict(mt=mt, score=score))
+    norms = [2.5, 40.]
+    thresholds = [.9, 0., .5, .55, .3, 1., .999]
+    hists, efficiencies = make_summed_histograms_scan('scan', ds, norms, thresholds)
+    for threshold, h, eff in zip(thresholds, hists, efficiencies.T):
+        h_ref = make_summed_histogram('ref', ds, norms, threshold)
+        np.testing.assert_allclose(h.values, h_ref.values, rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(h.sumw2, h_ref.sumw2, rtol=1e-10, atol=1e-12)
+        assert h.entries == h_ref.entries
+        np.testing.assert_allclose(eff, [(d['score'] > threshold).sum() / len(d['score']) for d in ds])
+    print('Succeeded')
+
+
+def test_process_bkg_resume():
+    '''
+    Interrupts a chunked process_bkg run on synthetic events, restarts it, and
+    compares the saved chunks with an uninterrupted run
+    '''
+    import dataset, shutil
+    from benchmark import synthetic_arrays
+    arrays = synthetic_arrays(4000)
+    chunk_size = 500
+    n_interrupt = [0]
+
+    def iter_synthetic_chunks(rootfile, stages=None, entrystart=0, entrystop=None, **kwargs):
+        stop = 4000 if entrystop is None else min(entrystop, 4000)
+        for lo in range(entrystart, stop, chunk_size):
+            if n_interrupt[0] == 0: raise KeyboardInterrupt
+            n_interrupt[0] -= 1
+            yield dataset.EventChunk(arrays).select(np.arange(lo, min(lo + chunk_size, stop)))
+
+    def run(interrupt_after=None):
+        n_interrupt[0] = -1 if interrupt_after is None else interrupt_after
+        try:
+            dataset.process_bkg(['bkg/sample/file.root'], chunked_save=50)
+        except KeyboardInterrupt:
+            return False
+        return True
+
+    def saved_X():
+        chunkfiles = sorted(glob.glob('data/bkg/sample/file_*.npz'), key=lambda f: int(f.rsplit('_', 1)[1][:-4]))
+        return np.concatenate([np.load(f)['X'] for f in chunkfiles])
+
+    cwd = os.getcwd()
+    iter_chunks_orig = dataset.iter_chunks
+    dataset.iter_chunks = iter_synthetic_chunks
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.chdir(tmpdir)
+            assert run()
+            X_ref = saved_X()
+            shutil.rmtree('data')
+            assert not run(interrupt_after=3)
+            assert not run(interrupt_after=2)
+            assert run()
+            np.testing.assert_array_equal(saved_X(), X_ref)
+            # A finished rootfile is skipped
+            assert run(interrupt_after=0)
+    finally:
+        os.chdir(cwd)
+        dataset.iter_chunks = iter_chunks_orig
+    print('Succeeded')
+
+
+def test_entry_ranges():
+    from dataset import entry_ranges
+    boundaries = [0, 1000, 2000, 3000, 4000]
+    # Only the baskets with a requested entry are read, consecutive ones joined
+    assert entry_ranges([5, 1500, 1600, 3999], boundaries=boundaries) == [(0, 2000), (3000, 4000)]
+    assert entry_ranges([2500], boundaries=boundaries) == [(2000, 3000)]
+    assert entry_ranges([], boundaries=boundaries) == []
+    # An entry every 30 is in every basket: everything is read
+    assert entry_ranges(np.arange(9, 4000, 30), boundaries=boundaries) == [(0, 4000)]
+    assert entry_ranges([1, 2, 3, 10, 11], max_gap=0) == [(1, 4), (10, 12)]
+    assert entry_ranges([1, 2, 3, 10, 11], max_gap=6) == [(1, 12)]
+    print('Succeeded')
+
+
+def test_get_scores_remote():
+    '''
+    Streams the test rootfile from a local http server that serves byte ranges,
+    and compares with reading the file directly
+    '''
+    import http.server, threading, functools, re
+
+    class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+        '''SimpleHTTPRequestHandler with support for single byte range requests'''
+        def send_head(self):
+            match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+            path = self.translate_path(self.path)
+            if match is None or not osp.isfile(path):
+                return super().send_head()
+            size = osp.getsize(path)
+            start, stop = match.groups()
+            if start:
+                start, stop = int(start), min(int(stop), size-1) if stop else size-1
+            else:
+                start, stop = max(size - int(stop), 0), size-1
+            if start > stop:
+                self.send_error(416, 'Requested range not satisfiable')
+                return None
+            f = open(path, 'rb')
+            f.seek(start)
+            self.send_response(206)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Range', f'bytes {start}-{stop}/{size}')
+            self.send_header('Content-Length', str(stop - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            self.range_length = stop - start + 1
+            return f
+
+        def copyfile(self, source, outputfile):
+            n = getattr(self, 'range_length', None)
+            if n is None: return super().copyfile(source, outputfile)
+            while n > 0:
+                block = source.read(min(n, 64*1024))
+                if not block: break
+                outputfile.write(block)
+                n -= len(block)
+
+    model = xgb.XGBClassifier()
+    model.load_model('/Users/klijnsma/work/svj/bdt/svjbdt_Aug02.json')
+    rootfile = 'TREEMAKER_genjetpt375_Jul21_mz250_mdark10_rinv0.337.root'
+    handler = functools.partial(RangeRequestHandler, directory=osp.dirname(osp.abspath(rootfile)))
+    server = http.server.ThreadingHTTPServer(('localhost', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f'http://localhost:{server.server_address[1]}/{osp.basename(rootfile)}'
+        d_remote = get_scores(url, model, remote_options=dict(chunkbytes=64*1024))
+    finally:
+        server.shutdown()
+    d_local = get_scores(rootfile, model)
+    for key in d_local:
+        np.testing.assert_array_equal(d_local[key], d_remote[key])
+    print('Succeeded')
+
+
+def test_histogram():
+    import ROOT
+    from array import array
+    mt = np.concatenate((np.random.uniform(100., 600., 1000), [160., 504., 152., np.nan]))
+    h = make_mt_histogram('h', mt, normalization=10.)
+    h_root = ROOT.TH1F('h_root', 'h_root', len(MT_BINNING)-1, array('f', MT_BINNING))
+    for x in mt: h_root.Fill(x)
+    h_root.Scale(10. / h_root.Integral(0, h_root.GetNbinsX()+1))
+    np.testing.assert_almost_equal(
+        h.values,
+        np.array([h_root.GetBinContent(i) for i in range(h_root.GetNbinsX()+2)]),
+        decimal=5
+        )
+    np.testing.assert_almost_equal(
+        np.sqrt(h.sumw2),
+        np.array([h_root.GetBinError(i) for i in range(h_root.GetNbinsX()+2)]),
+        decimal=5
+        )
+    print('Succeeded')
+
+
 def test_sum_hists():
     import ROOT
     h1 = ROOT.TH1F('h1', 'h1', 10, array('f', np.linspace(200., 400., 11)))
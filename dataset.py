@@ -1,5 +1,7 @@
 
-import os, os.path as osp, glob
+import os, os.path as osp, glob, time, collections, shutil, tempfile
+import hashlib, inspect, json, zlib
+import concurrent.futures
 import numpy as np
 import tqdm
 import uptools, seutils
@@ -28,37 +30,394 @@ class Bunch:
                 return 1
 
 
+class JaggedArray:
+    """
+    Minimal jagged array: a flat `content` array plus `offsets`, such that the
+    entries of event i are content[offsets[i]:offsets[i+1]]
+    """
+    def __init__(self, content, offsets):
+        self.content = np.asarray(content)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_counts(cls, content, counts):
+        offsets = np.zeros(len(counts)+1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(content, offsets)
+
+    @classmethod
+    def from_list(cls, arrays):
+        """Builds a JaggedArray out of a sequence of per-event arrays"""
+        arrays = [np.asarray(a) for a in arrays]
+        content = np.concatenate(arrays) if len(arrays) else np.zeros(0)
+        return cls.from_counts(content, [len(a) for a in arrays])
+
+    @classmethod
+    def from_any(cls, array):
+        """
+        Converts whatever the reader returns for a jagged branch (awkward0
+        JaggedArray, object array of arrays, list of arrays) to a JaggedArray
+        """
+        if isinstance(array, cls):
+            return array
+        if hasattr(array, 'content') and hasattr(array, 'offsets'):
+            # awkward0 JaggedArray; make sure the offsets are contiguous
+            if hasattr(array, 'compact'): array = array.compact()
+            return cls(array.content, array.offsets)
+        return cls.from_list(array)
+
+    @property
+    def starts(self):
+        return self.offsets[:-1]
+
+    @property
+    def stops(self):
+        return self.offsets[1:]
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    @property
+    def parents(self):
+        """Event index of every element in content"""
+        return np.repeat(np.arange(len(self)), self.counts)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, where):
+        """Event selection; `where` is a mask or an index array over events"""
+        starts = self.starts[where]
+        counts = self.stops[where] - starts
+        new = self.from_counts(None, counts)
+        index = np.repeat(starts - new.starts, counts) + np.arange(new.offsets[-1])
+        new.content = self.content[index]
+        return new
+
+    def at(self, i, fill=np.nan):
+        """
+        Returns the i-th entry of every event as a flat array. Events with
+        fewer than i+1 entries get `fill`.
+        """
+        return self.take(np.full(len(self), i), fill)
+
+    def take(self, index, fill=np.nan):
+        """
+        Returns entry index[j] of event j for every event as a flat array.
+        Events where the index is negative or out of range get `fill`.
+        """
+        has = (index >= 0) & (index < self.counts)
+        if has.all():
+            return self.content[self.starts + index]
+        out = np.full(len(self), fill, dtype=np.result_type(self.content.dtype, fill))
+        out[has] = self.content[self.starts[has] + index[has]]
+        return out
+
+
+def as_column(array):
+    """
+    Returns a flat np.ndarray for per-event branches, and a JaggedArray for
+    branches with a variable number of entries per event
+    """
+    if isinstance(array, np.ndarray) and array.dtype != object:
+        return array
+    return JaggedArray.from_any(array)
+
+
+class EventChunk:
+    """
+    A chunk of events in columnar form. Branches are accessed by their name,
+    just like for the per-event dicts of uptools.iter_events, but return
+    a column over all events in the chunk.
+    """
+    def __init__(self, arrays, selection=None):
+        self.arrays = arrays
+        self.selection = selection
+        self._columns = {}
+
+    def __getitem__(self, key):
+        if key not in self._columns:
+            column = as_column(self.arrays[key])
+            if self.selection is not None: column = column[self.selection]
+            self._columns[key] = column
+        return self._columns[key]
+
+    def __contains__(self, key):
+        return key in self.arrays
+
+    def __len__(self):
+        if self.selection is not None:
+            return len(self.selection)
+        for key in self.arrays:
+            return len(self[key])
+        return 0
+
+    def select(self, where):
+        """
+        Returns a new chunk with only the selected events. Columns are only
+        selected when they are accessed, so unused branches cost nothing.
+        """
+        selection = np.arange(len(self)) if self.selection is None else self.selection
+        return self.__class__(self.arrays, selection[where])
+
+
+class ColumnBuffer:
+    """
+    Growable buffer of named, typed columns. Single rows (`append`) or chunks
+    of rows (`extend`) are written into preallocated arrays whose capacity
+    doubles when full, so there are no per-value Python objects and no copy
+    at the end: `freeze` returns the filled part of every column as views.
+
+    `columns` is a list of names or a dict of name -> dtype; columns without a
+    dtype get `dtype` (pass np.float32 to halve the memory).
+    """
+    def __init__(self, columns, dtype=np.float64, capacity=1024):
+        if not isinstance(columns, dict): columns = dict.fromkeys(columns)
+        self.dtypes = {c: np.dtype(dtype if t is None else t) for c, t in columns.items()}
+        self.data = {c: np.empty(capacity, t) for c, t in self.dtypes.items()}
+        self.size = 0
+        self.frozen = False
+
+    @property
+    def columns(self):
+        return list(self.dtypes)
+
+    @property
+    def capacity(self):
+        return min(len(array) for array in self.data.values())
+
+    def __len__(self):
+        return self.size
+
+    def reserve(self, n):
+        """Makes room for n more rows"""
+        if self.frozen: raise RuntimeError('Cannot add rows to a frozen ColumnBuffer')
+        needed = self.size + n
+        capacity = self.capacity
+        if needed <= capacity: return
+        capacity = max(capacity, 1)
+        while capacity < needed: capacity *= 2
+        for c, array in self.data.items():
+            grown = np.empty(capacity, array.dtype)
+            grown[:self.size] = array[:self.size]
+            self.data[c] = grown
+
+    def append(self, row):
+        """Appends a single row: a dict, or a sequence in the order of the columns"""
+        if not isinstance(row, dict): row = dict(zip(self.dtypes, row))
+        self.reserve(1)
+        for c, value in row.items():
+            self.data[c][self.size] = value
+        self.size += 1
+
+    def extend(self, rows):
+        """Appends a chunk of rows: a dict of arrays, or a sequence of arrays in the order of the columns"""
+        if not isinstance(rows, dict): rows = dict(zip(self.dtypes, rows))
+        n = len(next(iter(rows.values())))
+        self.reserve(n)
+        for c, values in rows.items():
+            self.data[c][self.size:self.size+n] = values
+        self.size += n
+
+    def freeze(self):
+        """
+        Returns a dict column -> array of the rows added so far. The arrays are
+        views on the buffer, which can not be added to anymore.
+        """
+        self.frozen = True
+        return {c: array[:self.size] for c, array in self.data.items()}
+
+
+TREENAME = 'TreeMaker2/PreSelection'
+
+# Source options for streaming remote files (see uproot3.open): chunkbytes is
+# the size of a single ranged read, limitbytes the size of the read-ahead cache
+REMOTE_READ_OPTIONS = dict(chunkbytes=1024**2, limitbytes=64*1024**2)
+
+def is_remote(path):
+    return '://' in path and not path.startswith('file://')
+
+def import_uproot3():
+    """Returns the uproot3 module (the uproot3 package, or uproot<4)"""
+    try:
+        import uproot3 as uproot
+    except ImportError:
+        import uproot
+        if int(uproot.__version__.split('.')[0]) >= 4:
+            raise ImportError(
+                f'Streaming remote rootfiles needs uproot3 (found uproot {uproot.__version__});'
+                ' pip install uproot3'
+                )
+    return uproot
+
+def open_tree(rootfile, treename=TREENAME, remote_options=None):
+    """
+    Opens the tree of a local or remote rootfile with uproot3. Remote files
+    are read with ranged reads; `remote_options` update REMOTE_READ_OPTIONS.
+    """
+    uproot = import_uproot3()
+    options = dict(REMOTE_READ_OPTIONS, **(remote_options or {}))
+    return uproot.open(rootfile, xrootdsource=options, httpsource=options)[treename]
+
+def iter_remote_arrays(rootfile, treename=TREENAME, remote_options=None, **kwargs):
+    """
+    Reads arrays directly from a remote (root:// or http(s)://) rootfile with
+    ranged reads, so only the baskets of the requested branches are transferred.
+    `remote_options` update REMOTE_READ_OPTIONS. Keyword arguments are passed
+    to TTree.iterate. Needs the uproot3 API (the uproot3 package, or uproot<4).
+    """
+    for arrays in open_tree(rootfile, treename, remote_options).iterate(**kwargs):
+        yield arrays
+
+def iter_chunks(rootfiles, stages=None, remote_options=None, **kwargs):
+    """
+    Like uptools.iter_events, but yields EventChunk's of many events at a time.
+    If `stages` is given, only the branches those stages need (see
+    BRANCH_SCHEMA) are read. Remote rootfiles are streamed with
+    iter_remote_arrays, local ones are read with uptools.iter_arrays.
+    Keyword arguments are passed to the reader.
+    """
+    if stages is not None: kwargs['branches'] = get_branches(*stages)
+    if isinstance(rootfiles, str): rootfiles = [rootfiles]
+    for rootfile in rootfiles:
+        if is_remote(rootfile):
+            arrays_iter = iter_remote_arrays(rootfile, remote_options=remote_options, **kwargs)
+        else:
+            arrays_iter = uptools.iter_arrays(rootfile, **kwargs)
+        for arrays in arrays_iter:
+            yield EventChunk(arrays)
+
+
+def cluster_boundaries(rootfile, branches=None, remote_options=None):
+    """
+    Entry numbers at which the baskets of all the given branches start
+    together (the clusters of uproot3 TTree.clusters), plus the number of
+    entries. A basket is always read and decompressed as a whole.
+    """
+    clusters = list(open_tree(rootfile, remote_options=remote_options).clusters(branches))
+    if not clusters: return np.zeros(1, dtype=np.int64)
+    return np.array([start for start, _ in clusters] + [clusters[-1][1]], dtype=np.int64)
+
+
+def entry_ranges(entries, max_gap=0, boundaries=None):
+    """
+    Merges sorted entry numbers into [start, stop) ranges.
+
+    With `boundaries` (see cluster_boundaries), the ranges are the clusters
+    that hold at least one of the entries, with consecutive clusters joined:
+    exactly the baskets that have to be read. Otherwise entries less than
+    max_gap entries apart end up in the same range.
+    """
+    entries = np.asarray(entries)
+    if len(entries) == 0: return []
+    if boundaries is not None:
+        boundaries = np.asarray(boundaries)
+        clusters = np.unique(np.searchsorted(boundaries, entries, side='right') - 1)
+        breaks = np.nonzero(np.diff(clusters) > 1)[0] + 1
+        starts = boundaries[clusters[np.concatenate(([0], breaks))]]
+        stops = boundaries[clusters[np.concatenate((breaks - 1, [len(clusters)-1]))] + 1]
+        return list(zip(starts.tolist(), stops.tolist()))
+    breaks = np.nonzero(np.diff(entries) > max_gap + 1)[0] + 1
+    starts = entries[np.concatenate(([0], breaks))]
+    stops = entries[np.concatenate((breaks - 1, [len(entries)-1]))] + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def iter_indexed_chunks(rootfile, entries, stages=None, remote_options=None, max_gap=None):
+    """
+    Like iter_chunks for a single rootfile, but only reads the given (sorted)
+    entries, e.g. the passing entries of a PreselectionIndex. The yielded
+    EventChunks only contain the requested entries.
+
+    By default only the baskets that hold a requested entry are read (see
+    cluster_boundaries and entry_ranges); pass max_gap to merge entries into
+    ranges by distance instead. What this saves depends on how the entries
+    are spread: with a pass rate of a few percent (QCD) nearly every basket
+    holds a passing entry, so all baskets of the needed branches are still
+    read, and the saving is only that the preselection branches are not read
+    and the preselection is not run. Fewer baskets are read for samples with
+    a low pass rate, or where the passing entries are clustered.
+    """
+    entries = np.asarray(entries)
+    if max_gap is None:
+        boundaries = cluster_boundaries(rootfile, get_branches(*stages) if stages else None, remote_options)
+        ranges = entry_ranges(entries, boundaries=boundaries)
+    else:
+        ranges = entry_ranges(entries, max_gap)
+    for start, stop in ranges:
+        offset = start
+        for chunk in iter_chunks(rootfile, stages, remote_options, entrystart=start, entrystop=stop):
+            n = len(chunk)
+            lo, hi = np.searchsorted(entries, [offset, offset+n])
+            yield chunk.select(entries[lo:hi] - offset)
+            offset += n
+
+
 class FourVectorArray:
     """
-    Wrapper class for Bunch, with more specific 4-vector stuff
+    Column store for 4-vectors (pt, eta, phi, energy) plus any other per-object
+    variables passed as keyword arguments.
+
+    px, py, pz and mass are computed on first access and cached. Selections
+    apply to the cached components as well, so they are never recomputed;
+    slices of the underlying arrays are views.
     """
+    __slots__ = ('columns', 'cache')
+    DERIVED = ('px', 'py', 'pz', 'mass')
+
     def __init__(self, pt, eta, phi, energy, **kwargs):
-        self.bunch = Bunch(
-            pt=pt, eta=eta, phi=phi, energy=energy, **kwargs
-            )
+        object.__setattr__(self, 'columns', dict(pt=pt, eta=eta, phi=phi, energy=energy, **kwargs))
+        object.__setattr__(self, 'cache', {})
 
     def __getattr__(self, name):
-       return getattr(self.bunch, name)
+        if name in self.__slots__: raise AttributeError(name)
+        try:
+            return self.columns[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in self.__slots__:
+            object.__setattr__(self, name, value)
+        elif name in self.DERIVED:
+            self.cache[name] = value
+        else:
+            if name in ('pt', 'eta', 'phi', 'energy'): self.cache.clear()
+            self.columns[name] = value
 
     def __getitem__(self, where):
-        new = self.__class__([], [], [], [])
-        new.bunch = self.bunch[where]
+        new = object.__new__(self.__class__)
+        object.__setattr__(new, 'columns', {k: v[where] for k, v in self.columns.items()})
+        object.__setattr__(new, 'cache', {k: v[where] for k, v in self.cache.items()})
         return new
 
     def __len__(self):
-        return len(self.bunch)
+        try:
+            return len(self.pt)
+        except TypeError:
+            return 1
 
     @property
     def px(self):
-        return np.cos(self.phi) * self.pt
+        if 'px' not in self.cache: self.cache['px'] = np.cos(self.phi) * self.pt
+        return self.cache['px']
 
     @property
     def py(self):
-        return np.sin(self.phi) * self.pt
+        if 'py' not in self.cache: self.cache['py'] = np.sin(self.phi) * self.pt
+        return self.cache['py']
 
     @property
     def pz(self):
-        return np.sinh(self.eta) * self.pt
+        if 'pz' not in self.cache: self.cache['pz'] = np.sinh(self.eta) * self.pt
+        return self.cache['pz']
+
+    @property
+    def mass(self):
+        if 'mass' not in self.cache:
+            self.cache['mass'] = np.sqrt(self.energy**2 - self.px**2 - self.py**2 - self.pz**2)
+        return self.cache['mass']
 
 
 def is_array(a):
@@ -91,52 +450,114 @@ def calc_dr(eta1, phi1, eta2, phi2):
     return np.sqrt((eta1-eta2)**2 + calc_dphi(phi1, phi2)**2)
 
 
-def calculate_mt_rt(jets, met, metphi):
+def match_dr(eta1, phi1, eta2, phi2):
+    """
+    For every object in collection 1, finds the object in collection 2 of the
+    same event that is nearest in delta R.
+
+    Collection 2 should be JaggedArrays. Collection 1 can be JaggedArrays, or
+    flat arrays with exactly one object per event (e.g. the subleading jet).
+    Returns (index, dr) in the same shape as collection 1, where index is the
+    index of the nearest object within the event in collection 2 (-1 if the
+    event has none) and dr the corresponding delta R (inf if none). Ties go to
+    the lowest index.
+    """
+    flat = not isinstance(eta1, JaggedArray)
+    if flat:
+        eta1 = JaggedArray.from_counts(eta1, np.ones(len(eta1), dtype=np.int64))
+        phi1 = JaggedArray(phi1, eta1.offsets)
+    n1 = eta1.counts
+    n2 = eta2.counts
+    # Build all (object 1, object 2) pairs per event, object 1 major
+    n_pairs = n1 * n2
+    pair_offsets = np.zeros(len(n_pairs)+1, dtype=np.int64)
+    np.cumsum(n_pairs, out=pair_offsets[1:])
+    pair_event = np.repeat(np.arange(len(n_pairs)), n_pairs)
+    k = np.arange(pair_offsets[-1]) - pair_offsets[pair_event]
+    n2_pair = n2[pair_event]
+    i1 = eta1.starts[pair_event] + k // n2_pair
+    i2_local = k % n2_pair
+    i2 = eta2.starts[pair_event] + i2_local
+    dr = calc_dr(eta1.content[i1], phi1.content[i1], eta2.content[i2], phi2.content[i2])
+
+    # Pairs of one object 1 form contiguous segments of length n2
+    index = np.full(len(eta1.content), -1, dtype=np.int64)
+    min_dr = np.full(len(eta1.content), np.inf)
+    has_match = n2[eta1.parents] > 0
+    if pair_offsets[-1] > 0:
+        segment_starts = np.zeros(has_match.sum(), dtype=np.int64)
+        np.cumsum(n2[eta1.parents][has_match][:-1], out=segment_starts[1:])
+        segment_min = np.fmin.reduceat(dr, segment_starts)
+        segment = np.repeat(np.arange(len(segment_starts)), n2[eta1.parents][has_match])
+        is_min = dr == segment_min[segment]
+        first_segment, first = np.unique(segment[is_min], return_index=True)
+        i_min = np.flatnonzero(is_min)[first]
+        matched = np.flatnonzero(has_match)[first_segment]
+        index[matched] = i2_local[i_min]
+        min_dr[matched] = dr[i_min]
+
+    if flat:
+        return index, min_dr
+    return JaggedArray(index, eta1.offsets), JaggedArray(min_dr, eta1.offsets)
+
+
+KINEMATICS = ('mt', 'rt', 'metdphi', 'mass', 'massmet', 'massmetpz', 'massmetpzm')
+
+def calculate_kinematics(jets, met, metphi, variables=KINEMATICS):
+    """
+    Fused calculation of the transverse-mass and mass hypotheses of jets + MET.
+    Intermediate quantities (MET components, pz, visible mass, ...) are computed
+    once and shared between all requested variables.
+    Works on scalars as well as on arrays. Returns a dict variable -> value.
+    """
+    out = {}
     met_x = np.cos(metphi) * met
     met_y = np.sin(metphi) * met
-    jet_x = np.cos(jets.phi) * jets.pt
-    jet_y = np.sin(jets.phi) * jets.pt
-    jet_e = np.sqrt(jets.energy**2 - jets.pz**2)
-    mt = np.sqrt( (jet_e + met)**2 - (jet_x + met_x)**2 - (jet_y + met_y)**2 )
-    rt = np.sqrt(1+ met / jets.pt)
-    return mt, rt
+    pz2 = jets.pz**2
+    if 'mt' in variables:
+        jet_e = np.sqrt(jets.energy**2 - pz2)
+        out['mt'] = np.sqrt((jet_e + met)**2 - (jets.px + met_x)**2 - (jets.py + met_y)**2)
+    if 'rt' in variables:
+        out['rt'] = np.sqrt(1. + met / jets.pt)
+    if 'metdphi' in variables:
+        out['metdphi'] = calc_dphi(jets.phi, metphi)
+    if 'mass' in variables:
+        out['mass'] = jets.mass
+    if any(v.startswith('massmet') for v in variables):
+        mass2 = jets.mass**2
+        jet_p = np.sqrt(pz2 + jets.pt**2 + mass2)
+        # pt * met * cos(dphi(jet, met))
+        ptmet_cos = jets.px * met_x + jets.py * met_y
+        if 'massmet' in variables:
+            out['massmet'] = np.sqrt(mass2 + 2 * met * jet_p - 2 * ptmet_cos)
+        if 'massmetpz' in variables:
+            out['massmetpz'] = np.sqrt(
+                mass2 + 2 * np.sqrt(met**2 + pz2) * jet_p - 2 * (ptmet_cos + pz2)
+                )
+        if 'massmetpzm' in variables:
+            out['massmetpzm'] = np.sqrt(
+                2 * mass2 + 2 * np.sqrt(met**2 + pz2 + mass2) * jet_p - 2 * (ptmet_cos + pz2)
+                )
+    return out
+
+def calculate_mt_rt(jets, met, metphi):
+    kinematics = calculate_kinematics(jets, met, metphi, ['mt', 'rt'])
+    return kinematics['mt'], kinematics['rt']
 
 def calculate_mt(jets, met, metphi):
-    metx = np.cos(metphi) * met
-    mety = np.sin(metphi) * met
-    jets_transverse_e = np.sqrt(jets.energy**2 - jets.pz**2)
-    mass = np.sqrt(jets.energy**2 - jets.px**2 - jets.py**2 - jets.pz**2)
-    mt = np.sqrt(
-        (jets_transverse_e + met)**2
-        - (jets.px + metx)**2 - (jets.py + mety)**2
-        )
-    return mt
+    return calculate_kinematics(jets, met, metphi, ['mt'])['mt']
 
 def calculate_mass(jets):
-    mass = np.sqrt(jets.energy**2 - jets.px**2 - jets.py**2 - jets.pz**2)
-    return mass
+    return jets.mass
 
 def calculate_massmet(jets, met, metphi):
-    metx = np.cos(metphi) * met
-    mety = np.sin(metphi) * met
-    mass_viz = np.sqrt(jets.energy**2 - jets.px**2 - jets.py**2 - jets.pz**2)
-    metdphi = calc_dphi(jets.phi, metphi)
-    massmet = np.sqrt(mass_viz**2 + 2 * met * np.sqrt(jets.pz**2 + jets.pt**2 + mass_viz**2) - 2 * jets.pt * met * cos(metdphi))
-    return massmet
+    return calculate_kinematics(jets, met, metphi, ['massmet'])['massmet']
 
 def calculate_massmetpz(jets, met, metphi):
-    metx = np.cos(metphi) * met
-    mety = np.sin(metphi) * met
-    mass_viz = np.sqrt(jets.energy**2 - jets.px**2 - jets.py**2 - jets.pz**2)
-    mass = np.sqrt(mass_viz**2 + 2 * np.sqrt(met**2 + jets.pz**2 ) * np.sqrt(jets.pz**2 + jets.pt**2 + mass_viz**2) - 2 * (jets.pt * met * cos(calc_dphi(metphi, jets.phi)) + jets.pz**2))
-    return mass
+    return calculate_kinematics(jets, met, metphi, ['massmetpz'])['massmetpz']
 
 def calculate_massmetpzm(jets, met, metphi):
-    metx = np.cos(metphi) * met
-    mety = np.sin(metphi) * met
-    mass_viz = np.sqrt(jets.energy**2 - jets.px**2 - jets.py**2 - jets.pz**2)
-    mass = np.sqrt(2*mass_viz**2 +2*np.sqrt(met**2+jets.pz**2+mass_viz**2)*np.sqrt(jets.pz**2+jets.pt**2+mass_viz**2)-2*(jets.pt*met*cos(calc_dphi(metphi, jets.phi))+jets.pz**2))
-    return mass
+    return calculate_kinematics(jets, met, metphi, ['massmetpzm'])['massmetpzm']
 
 class CutFlowColumn:
     def __init__(self) -> None:
@@ -146,6 +567,12 @@ class CutFlowColumn:
         self.counts.setdefault(name, 0)
         self.counts[name] += 1
 
+    def plus(self, name, n):
+        """Like plus_one, but for n events at once"""
+        if n == 0: return
+        self.counts.setdefault(name, 0)
+        self.counts[name] += int(n)
+
     def __getitem__(self, name):
         return self.counts.get(name, 0)
 
@@ -207,6 +634,69 @@ def preselection(event, cut_flow=None):
     return True
 
 
+METFILTERS = [
+    b'HBHENoiseFilter',
+    b'HBHEIsoNoiseFilter',
+    b'eeBadScFilter',
+    b'ecalBadCalibReducedFilter',
+    b'BadPFMuonFilter',
+    b'BadChargedCandidateFilter',
+    b'globalSuperTightHalo2016Filter',
+    ]
+
+PRESELECTION_ECFS = [
+    b'JetsAK15_ecfC2b1',
+    b'JetsAK15_ecfD2b1',
+    b'JetsAK15_ecfM2b1',
+    b'JetsAK15_ecfN2b2',
+    ]
+
+def preselection_chunk(chunk, cut_flow=None):
+    """
+    Vectorized version of `preselection`, operating on an EventChunk.
+    Returns a boolean mask of events passing the preselection, and fills
+    cut_flow with the same counts as calling `preselection` per event would.
+
+    Cuts are written as `~(x fails)` rather than `x passes` so that NaNs are
+    treated like in the per-event comparisons. Comparisons are done in the
+    dtype of the branches (float32), like numpy does for the per-event scalars.
+    """
+    if cut_flow is None: cut_flow = CutFlowColumn()
+
+    def cut(passes, name):
+        cut_flow.plus(name, passes.sum())
+        return passes
+
+    pt = chunk[b'JetsAK15.fCoordinates.fPt']
+    passes = cut(pt.counts >= 2, '>=2jets')
+
+    eta = chunk[b'JetsAK15.fCoordinates.fEta'].at(1)
+    passes = cut(passes & ~(np.abs(eta) > 2.4), 'eta<2.4')
+
+    ak8_pt = chunk[b'JetsAK8.fCoordinates.fPt']
+    passes = cut(
+        passes & (ak8_pt.counts > 0) & ~(ak8_pt.at(0) < 550.),
+        'trigger'
+        )
+
+    for ecf in PRESELECTION_ECFS:
+        ecf = chunk[ecf]
+        passes &= (ecf.counts > 1) & ~(ecf.at(1) < 0.)
+    passes = cut(passes, 'ecf>0')
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rt = np.sqrt(1. + chunk[b'MET'] / pt.at(1))
+    passes = cut(passes & ~(rt < 1.1), 'rtx>1.1')
+
+    passes = cut(passes & ~((chunk[b'Muons'] > 0) | (chunk[b'Electrons'] > 0)), 'nleptons==0')
+
+    for metfilter in METFILTERS:
+        passes &= chunk[metfilter] != 0
+    passes = cut(passes, 'metfilter')
+    cut_flow.plus('preselection', passes.sum())
+    return passes
+
+
 def get_subl(event):
     """
     Returns subleading jet
@@ -246,6 +736,52 @@ def get_subl(event):
     subl.mass = calculate_mass(subl)
     return subl
 
+
+# Attribute name -> branch name of the AK15 jet variables other than the 4-vector
+AK15_BRANCHES = dict(
+    ecfC2b1 = b'JetsAK15_ecfC2b1',
+    ecfC2b2 = b'JetsAK15_ecfC2b2',
+    ecfC3b1 = b'JetsAK15_ecfC3b1',
+    ecfC3b2 = b'JetsAK15_ecfC3b2',
+    ecfD2b1 = b'JetsAK15_ecfD2b1',
+    ecfD2b2 = b'JetsAK15_ecfD2b2',
+    ecfM2b1 = b'JetsAK15_ecfM2b1',
+    ecfM2b2 = b'JetsAK15_ecfM2b2',
+    ecfM3b1 = b'JetsAK15_ecfM3b1',
+    ecfM3b2 = b'JetsAK15_ecfM3b2',
+    ecfN2b1 = b'JetsAK15_ecfN2b1',
+    ecfN2b2 = b'JetsAK15_ecfN2b2',
+    ecfN3b1 = b'JetsAK15_ecfN3b1',
+    ecfN3b2 = b'JetsAK15_ecfN3b2',
+    multiplicity = b'JetsAK15_multiplicity',
+    girth = b'JetsAK15_girth',
+    ptD = b'JetsAK15_ptD',
+    axismajor = b'JetsAK15_axismajor',
+    axisminor = b'JetsAK15_axisminor',
+    sdm = b'JetsAK15_softDropMass',
+    )
+
+def get_subl_chunk(chunk, kinematics=('rt', 'metdphi', 'mt')):
+    """
+    Vectorized version of `get_subl`, for an EventChunk of events that passed
+    the preselection. Returns a FourVectorArray with one entry (the subleading
+    jet) per event, including the derived `kinematics` columns (see
+    calculate_kinematics; all computed in one call) and mass.
+    Only the AK15 variables that were read into the chunk are included.
+    """
+    subl = FourVectorArray(
+        chunk[b'JetsAK15.fCoordinates.fPt'].at(1),
+        chunk[b'JetsAK15.fCoordinates.fEta'].at(1),
+        chunk[b'JetsAK15.fCoordinates.fPhi'].at(1),
+        chunk[b'JetsAK15.fCoordinates.fE'].at(1),
+        **{key: chunk[branch].at(1) for key, branch in AK15_BRANCHES.items() if branch in chunk}
+        )
+    met = chunk[b'MET']
+    metphi = chunk[b'METPhi']
+    for key, value in calculate_kinematics(subl, met, metphi, kinematics).items():
+        setattr(subl, key, value)
+    return subl
+
 def part_flavor(event):
     min_dr = 1000
     jets = FourVectorArray(
@@ -263,9 +799,30 @@ def part_flavor(event):
       if com_dr < min_dr:
         min_dr = com_dr
         l = j
-    ak4partFlav = jets[j]
+    if l == 1000:
+        # No AK4 jet to match; same as part_flavor_chunk
+        return FourVectorArray(np.nan, np.nan, np.nan, np.nan, partonFlovor=0)
+    ak4partFlav = jets[l]
     return ak4partFlav
 
+def part_flavor_chunk(chunk, subl=None):
+    """
+    Vectorized version of `part_flavor`: returns a FourVectorArray with, per
+    event, the AK4 jet closest in delta R to the subleading AK15 jet.
+    Events without AK4 jets get NaN kinematics and partonFlovor 0.
+    """
+    if subl is None: subl = get_subl_chunk(chunk)
+    eta = chunk[b'Jets.fCoordinates.fEta']
+    phi = chunk[b'Jets.fCoordinates.fPhi']
+    index, _ = match_dr(subl.eta, subl.phi, eta, phi)
+    return FourVectorArray(
+        chunk[b'Jets.fCoordinates.fPt'].take(index),
+        eta.take(index),
+        phi.take(index),
+        chunk[b'Jets.fCoordinates.fE'].take(index),
+        partonFlovor = chunk[b'Jets_partonFlavor'].take(index, fill=0),
+        )
+
 def Offset_Constituents(event):
     jets = FourVectorArray(
       event[b'JetsAK15_constituents.fCoordinates.fPt'],
@@ -277,109 +834,385 @@ def Offset_Constituents(event):
     jetsconst = jets[2]
     return jetsconst
 
-def process_signal(rootfiles, outfile=None):
-    n_total = 0
-    n_presel = 0
-    n_final = 0
-    X = []
-    for event in uptools.iter_events(rootfiles):
-        n_total += 1
-        if not preselection(event): continue
-        n_presel += 1
-        genparticles = FourVectorArray(
-            event[b'GenParticles.fCoordinates.fPt'],
-            event[b'GenParticles.fCoordinates.fEta'],
-            event[b'GenParticles.fCoordinates.fPhi'],
-            event[b'GenParticles.fCoordinates.fE'],
-            pdgid=event[b'GenParticles_PdgId'],
-            status=event[b'GenParticles_Status']
+AK15_P4 = [
+    b'JetsAK15.fCoordinates.fPt',
+    b'JetsAK15.fCoordinates.fEta',
+    b'JetsAK15.fCoordinates.fPhi',
+    b'JetsAK15.fCoordinates.fE',
+    ]
+
+# Branches needed per processing stage; read only what the stages of a job need
+BRANCH_SCHEMA = dict(
+    preselection = [
+        b'JetsAK15.fCoordinates.fPt', b'JetsAK15.fCoordinates.fEta',
+        b'JetsAK8.fCoordinates.fPt', b'MET', b'Muons', b'Electrons',
+        ] + PRESELECTION_ECFS + METFILTERS,
+    bdt = AK15_P4 + [b'MET', b'METPhi'] + [
+        AK15_BRANCHES[key] for key in [
+            'girth', 'axisminor', 'ecfM2b1', 'ecfD2b1', 'ecfC2b1', 'ecfN2b2', 'ptD', 'multiplicity'
+            ]
+        ],
+    histogram = AK15_P4 + [b'MET', b'METPhi', b'JetsAK8.fCoordinates.fPt'],
+    features = AK15_P4 + [b'MET', b'METPhi'] + list(AK15_BRANCHES.values()),
+    # Jet variables of the process_bkg and process_signal outputs (BKG_COLUMNS, SIGNAL_COLUMNS)
+    bkg = AK15_P4 + [b'MET', b'METPhi'] + [
+        AK15_BRANCHES[key] for key in [
+            'girth', 'axisminor', 'ecfM2b1', 'ecfD2b1', 'ecfC2b1', 'ecfN2b2', 'ptD', 'multiplicity', 'axismajor'
+            ]
+        ],
+    signal = AK15_P4 + [b'MET', b'METPhi'] + [
+        AK15_BRANCHES[key] for key in [
+            'girth', 'axisminor', 'ecfM2b1', 'ecfD2b1', 'ecfC2b1', 'ecfN2b2', 'ptD', 'multiplicity', 'axismajor', 'sdm'
+            ]
+        ],
+    flavor = [
+        b'Jets.fCoordinates.fPt',
+        b'Jets.fCoordinates.fEta',
+        b'Jets.fCoordinates.fPhi',
+        b'Jets.fCoordinates.fE',
+        b'Jets_partonFlavor',
+        ],
+    truth = [
+        b'GenParticles.fCoordinates.fPt',
+        b'GenParticles.fCoordinates.fEta',
+        b'GenParticles.fCoordinates.fPhi',
+        b'GenParticles.fCoordinates.fE',
+        b'GenParticles_PdgId',
+        b'GenParticles_Status',
+        ],
+    constituents = [
+        b'JetsAK15_constituents.fCoordinates.fPt',
+        b'JetsAK15_constituents.fCoordinates.fEta',
+        b'JetsAK15_constituents.fCoordinates.fPhi',
+        b'JetsAK15_constituents.fCoordinates.fE',
+        b'JetsAK15_constituentsOffsets',
+        ],
+    # The chunked signal processing only needs the per-jet constituent offsets
+    constituent_offsets = [b'JetsAK15_constituentsOffsets'],
+    )
+
+def get_branches(*stages):
+    """
+    Returns the list of branches needed for the given stages (keys of BRANCH_SCHEMA)
+    """
+    branches = []
+    for stage in stages:
+        for branch in BRANCH_SCHEMA[stage]:
+            if branch not in branches: branches.append(branch)
+    return branches
+
+
+# Column names of the rows of X in the process_signal and process_bkg outputs
+SIGNAL_COLUMNS = [
+    'girth', 'axisminor', 'ecfM2b1', 'ecfD2b1', 'ecfC2b1', 'ecfN2b2', 'metdphi', 'ptD', 'multiplicity', 'axismajor', 'offset_constituents',
+    'partonFlovor',
+    'pt', 'eta', 'phi', 'energy', 'rt', 'mt', 'met', 'sdm', 'mass',
+    ]
+BKG_COLUMNS = [
+    'ptD', 'axismajor', 'multiplicity',
+    'girth', 'axisminor', 'metdphi',
+    'ecfM2b1', 'ecfD2b1', 'ecfC2b1', 'ecfN2b2', 'partonFlovor',
+    'pt', 'eta', 'phi', 'energy', 'rt', 'mt',
+    ]
+
+
+ZPRIME_PDGID = 4900023
+DARKQUARK_PDGID = 4900101
+
+def select_truth_chunk(chunk, cut_flow=None, max_dr=1.5):
+    """
+    Vectorized truth matching of signal events, for an EventChunk of events
+    that passed the preselection. An event passes if it has a Z' and exactly
+    two dark quarks (status 71), and the (first) Z' and both dark quarks are
+    within delta R max_dr of the subleading AK15 jet. Every requirement is
+    counted in cut_flow. Returns the mask of passing events.
+    """
+    if cut_flow is None: cut_flow = CutFlowColumn()
+    pdgid = chunk[b'GenParticles_PdgId']
+    status = chunk[b'GenParticles_Status'].content
+    eta = chunk[b'GenParticles.fCoordinates.fEta'].content
+    phi = chunk[b'GenParticles.fCoordinates.fPhi'].content
+    parents = pdgid.parents
+    n = len(chunk)
+
+    def first_two(mask):
+        """Number of selected particles per event, and the indices of the first two"""
+        selected = np.flatnonzero(mask)
+        events, i_first, n_selected = np.unique(parents[selected], return_index=True, return_counts=True)
+        counts = np.zeros(n, dtype=np.int64)
+        counts[events] = n_selected
+        first = np.zeros(n, dtype=np.int64)
+        first[events] = selected[i_first]
+        second = np.zeros(n, dtype=np.int64)
+        two = n_selected > 1
+        second[events[two]] = selected[i_first[two] + 1]
+        return counts, first, second
+
+    n_zprime, zprime, _ = first_two(pdgid.content == ZPRIME_PDGID)
+    n_dq, dq1, dq2 = first_two((np.abs(pdgid.content) == DARKQUARK_PDGID) & (status == 71))
+
+    passes = n_zprime > 0
+    cut_flow.plus('zprime', passes.sum())
+    passes &= n_dq == 2
+    cut_flow.plus('darkquarks==2', passes.sum())
+
+    # Verify zprime and dark_quarks are within max_dr of the jet
+    jet_eta = chunk[b'JetsAK15.fCoordinates.fEta'].at(1)
+    jet_phi = chunk[b'JetsAK15.fCoordinates.fPhi'].at(1)
+    i = np.flatnonzero(passes)
+    matched = np.ones(len(i), dtype=bool)
+    for obj in [zprime, dq1, dq2]:
+        matched &= calc_dr(jet_eta[i], jet_phi[i], eta[obj[i]], phi[obj[i]]) < max_dr
+    passes[i] = matched
+    cut_flow.plus(f'truthdr<{max_dr}', passes.sum())
+    return passes
+
+
+def process_signal(rootfiles, outfile=None, cache=None, columnar=False, dtype=np.float64, index=None):
+    """
+    If columnar is True, the output is a column directory (see write_columns)
+    with the columns SIGNAL_COLUMNS instead of an .npz with a single X.
+    The features are stored with `dtype`. The cut flow, including the truth
+    requirements of select_truth_chunk, is saved with the features.
+    If a PreselectionIndex is passed, only the entries passing the
+    preselection are read.
+    With a cache, rootfiles must be a list (or a Prefetcher, keyed on its
+    remote rootfiles): a generator would have to be drained to make the key.
+    """
+    if outfile is None: outfile = 'data/signal.npz'
+    if columnar: outfile = osp.splitext(outfile)[0]
+    stages = ['signal', 'flavor', 'truth', 'constituent_offsets']
+    if cache is not None:
+        if isinstance(rootfiles, Prefetcher):
+            # Key on the remote rootfiles; on a hit nothing is copied
+            rootfiles.rootfiles = list(rootfiles.rootfiles)
+            names = rootfiles.rootfiles
+        elif isinstance(rootfiles, (str, list, tuple)):
+            names = uptools.format_rootfiles(rootfiles)
+        else:
+            raise TypeError(
+                'process_signal with a cache needs a list of rootfiles or a Prefetcher,'
+                f' not {type(rootfiles).__name__}'
+                )
+        key = cache.key(
+            names,
+            code=code_version(process_signal, preselection_chunk, select_truth_chunk, get_subl_chunk, part_flavor_chunk),
+            schema=get_branches('preselection', *stages),
+            dtype=np.dtype(dtype).str,
             )
+        if cache.fetch(key, outfile, names): return
+    cut_flow = CutFlowColumn()
+
+    def iter_preselected():
+        for rootfile, input_rootfile in iter_inputs(rootfiles):
+            if index is None:
+                for chunk in iter_chunks(input_rootfile, stages=['preselection'] + stages):
+                    cut_flow.plus('total', len(chunk))
+                    yield chunk.select(preselection_chunk(chunk, cut_flow))
+            else:
+                entries, file_cut_flow = index.load(rootfile, input_rootfile)
+                for name, n in file_cut_flow.counts.items(): cut_flow.plus(name, n)
+                yield from iter_indexed_chunks(input_rootfile, entries, stages, index.remote_options)
+
+    X = ColumnBuffer(SIGNAL_COLUMNS, dtype)
+    for chunk in iter_preselected():
+        if len(chunk) == 0: continue
+        chunk = chunk.select(select_truth_chunk(chunk, cut_flow))
+        if len(chunk) == 0: continue
+        subl = get_subl_chunk(chunk)
+        ak4partFlav = part_flavor_chunk(chunk, subl)
+        # Offset of the third AK15 jet (see Offset_Constituents); NaN if there is none
+        offset_constituents = chunk[b'JetsAK15_constituentsOffsets'].at(2)
+        X.extend([
+            subl.girth, subl.axisminor, subl.ecfM2b1, subl.ecfD2b1, subl.ecfC2b1, subl.ecfN2b2, subl.metdphi, subl.ptD, subl.multiplicity, subl.axismajor, offset_constituents,
+            ak4partFlav.partonFlovor,
+            subl.pt, subl.eta, subl.phi, subl.energy, subl.rt, subl.mt, chunk[b'MET'], subl.sdm, subl.mass,
+            ])
 
-        zprime = genparticles[genparticles.pdgid == 4900023]
-        if len(zprime) == 0: continue
-        zprime = zprime[0]
-
-        dark_quarks = genparticles[(np.abs(genparticles.pdgid) == 4900101) & (genparticles.status == 71)]
-        if len(dark_quarks) != 2: continue
-        subl = get_subl(event)
-        ak4partFlav = part_flavor(event)
-        jetsconst = Offset_Constituents(event)
-        met = event[b'MET']
-
-        # Verify zprime and dark_quarks are within 1.5 of the jet
-        if not all(calc_dr(subl.eta, subl.phi, obj.eta, obj.phi) < 1.5 for obj in [
-            zprime, dark_quarks[0], dark_quarks[1]
-            ]):
-            continue
+    n_total = cut_flow['total']
+    n_presel = cut_flow['preselection']
+    n_final = len(X)
+    print(f'n_total: {n_total}; n_presel: {n_presel}; n_final: {n_final} ({100.*n_final/max(n_total, 1):.2f}%)')
+    print('Cut flow: ' + ', '.join(f'{name}: {n}' for name, n in cut_flow.counts.items()))
+
+    print(f'Saving {n_final} entries to {outfile}')
+    columns = X.freeze()
+    counts = dict(cut_flow.counts, n_total=n_total, n_presel=n_presel, n_final=n_final)
+    if columnar:
+        write_columns(outfile, dict(columns, **counts))
+    else:
+        outdir = osp.abspath(osp.dirname(outfile))
+        if not osp.isdir(outdir): os.makedirs(outdir)
+        np.savez(outfile, X=np.stack([columns[c] for c in SIGNAL_COLUMNS], axis=1) if len(X) else np.array([]), **counts)
+    if cache is not None: cache.store(key, outfile)
 
-        n_final += 1
 
-        '''X.append([
-            subl.girth, subl.axismajor, subl.axisminor, subl.ecfM2b1, subl.ecfD2b1, subl.ecfC2b1, subl.ecfN2b2, subl.metdphi, subl.ptD, subl.multiplicity, jetsconst.offset_constituents,
-            ak4partFlav.partonFlovor,
-            subl.pt, subl.eta, subl.phi, subl.energy, subl.rt, subl.mt, met, subl.sdm,
-            ])'''
-        X.append([
-            subl.girth, subl.axisminor, subl.ecfM2b1, subl.ecfD2b1, subl.ecfC2b1, subl.ecfN2b2, subl.metdphi, subl.ptD, subl.multiplicity, subl.axismajor, jetsconst.offset_constituents,
-            ak4partFlav.partonFlovor,
-            subl.pt, subl.eta, subl.phi, subl.energy, subl.rt, subl.mt, met, subl.sdm, subl.mass,
-            ])
+def save_bkg(outfile, X, columnar=False, cutflow=None, metadata=None):
+    """
+    Saves the ColumnBuffer X of process_bkg to outfile
+    """
+    n = len(X)
+    columns = X.freeze()
+    if columnar:
+        write_columns(outfile, dict(columns, **(cutflow or {})), metadata)
+    else:
+        outdir = osp.abspath(osp.dirname(outfile))
+        if not osp.isdir(outdir): os.makedirs(outdir)
+        np.savez(outfile, X=np.stack([columns[c] for c in BKG_COLUMNS], axis=1) if n else np.array([]))
 
 
-        '''X.append([
-            subl.ptD, subl.axismajor, subl.multiplicity,
-            subl.girth, subl.axisminor, subl.metdphi,
-            subl.ecfM2b1, subl.ecfD2b1, subl.ecfC2b1, subl.ecfN2b2, ak4partFlav.partonFlovor,
-            subl.pt, subl.eta, subl.phi, subl.energy, subl.rt, subl.mt, met, subl.sdm
-            ])'''
+def read_checkpoint(checkpoint):
+    if not osp.isfile(checkpoint): return None
+    with open(checkpoint) as f:
+        return json.load(f)
 
-    print(f'n_total: {n_total}; n_presel: {n_presel}; n_final: {n_final} ({100.*n_final/float(n_total):.2f}%)')
 
-    if outfile is None: outfile = 'data/signal.npz'
-    outdir = osp.abspath(osp.dirname(outfile))
-    if not osp.isdir(outdir): os.makedirs(outdir)
-    print(f'Saving {n_final} entries to {outfile}')
-    np.savez(outfile, X=X)
+def write_checkpoint(checkpoint, state):
+    """Writes the checkpoint atomically, so a preempted job never leaves a broken one"""
+    tmp = checkpoint + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, checkpoint)
+
+
+def process_bkg(rootfiles, outfile=None, chunked_save=None, nmax=None, cache=None, columnar=False, dtype=np.float64, index=None):
+    """
+    If columnar is True, every output is a column directory (see write_columns)
+    with the columns BKG_COLUMNS instead of an .npz with a single X.
+    The features are stored with `dtype`.
 
+    If chunked_save is set, the features are flushed to numbered chunk files
+    <output>_<i>.npz whenever at least chunked_save events passed the
+    preselection, and <output>.checkpoint.json records the first entry that is
+    not saved yet. A restarted job continues from the checkpoint; finished
+    rootfiles are skipped.
 
-def process_bkg(rootfiles, outfile=None, chunked_save=None, nmax=None):
-#def process_bkg(rootfiles, outfile=None):
+    If nmax is set, at most the first nmax entries of every rootfile are
+    processed.
+
+    If a PreselectionIndex is passed, only the entries passing the
+    preselection are read.
+
+    rootfiles can be a Prefetcher: outputs, cache keys and checkpoints are
+    then named after the remote rootfiles rather than the local copies, and
+    cache hits are fetched before the transfers start, so they are not copied.
+    """
     n_total_all = 0
     n_presel_all = 0
-    for rootfile in uptools.format_rootfiles(rootfiles):
+    stages = ['preselection', 'bkg', 'flavor']
+    use_cache = cache is not None and not chunked_save
+
+    def output_for(rootfile):
+        outfile = 'data/bkg/{}.npz'.format(dirname_plus_basename(rootfile).replace('.root', ''))
+        return osp.splitext(outfile)[0] if columnar else outfile
+
+    def cache_key(rootfile):
+        return cache.key(
+            rootfile, code=code_version(process_bkg, preselection_chunk, get_subl_chunk, part_flavor_chunk),
+            schema=get_branches(*stages), nmax=nmax, dtype=np.dtype(dtype).str,
+            )
+
+    prefetched = use_cache and isinstance(rootfiles, Prefetcher)
+    if prefetched:
+        # Look up the remote rootfiles before copying; on a hit nothing is copied
+        rootfiles.rootfiles = [
+            rootfile for rootfile in rootfiles.rootfiles
+            if not cache.fetch(cache_key(rootfile), output_for(rootfile), rootfile)
+            ]
+
+    for rootfile, input_rootfile in iter_inputs(rootfiles):
         print('first debug in process_bkg')
-        X = []
-        n_total_this = 0
-        n_presel_this = 0
+        outfile = output_for(rootfile)
+        if use_cache:
+            key = cache_key(rootfile)
+            if not prefetched and cache.fetch(key, outfile, rootfile): continue
+
+        base, ext = osp.splitext(outfile)
+        checkpoint = base + '.checkpoint.json'
+        state = dict(rootfile=rootfile, entry=0, n_chunks=0, n_total=0, n_presel=0, done=False)
+        if chunked_save:
+            previous = read_checkpoint(checkpoint)
+            if previous and previous['rootfile'] == rootfile:
+                if previous['done']:
+                    print(f'{rootfile} already done according to {checkpoint}, skipping')
+                    continue
+                state = previous
+                print(f'Resuming {rootfile} from entry {state["entry"]} ({state["n_chunks"]} chunks saved)')
+
+        def flush():
+            chunkfile = f'{base}_{state["n_chunks"]}{ext}'
+            print(f'Saving {len(X)} entries to {chunkfile}')
+            save_bkg(chunkfile, X, columnar, metadata=dict(input=rootfile))
+            state['n_chunks'] += 1
+
+        kwargs = {}
+        if state['entry']: kwargs['entrystart'] = state['entry']
+        if nmax: kwargs['entrystop'] = nmax
+        X = ColumnBuffer(BKG_COLUMNS, dtype)
+        n_total_this = state['n_total']
+        n_presel_this = state['n_presel']
+        if index is None:
+            chunks = iter_chunks(input_rootfile, stages=stages, **kwargs)
+        else:
+            entries, cutflow = index.load(rootfile, input_rootfile)
+            stop = cutflow['total'] if not nmax else min(nmax, cutflow['total'])
+            entries = entries[(entries >= state['entry']) & (entries < stop)]
+            chunks = iter_indexed_chunks(input_rootfile, entries, stages=['bkg', 'flavor'])
+            n_read = 0
         try:
-            for event in uptools.iter_events(rootfile):
-                n_total_this += 1
-                n_total_all += 1
-                if not preselection(event): continue
-                n_presel_this += 1
-                n_presel_all += 1
-                subl = get_subl(event)
-                ak4partFlav = part_flavor(event)
-                X.append([
-                   subl.ptD, subl.axismajor, subl.multiplicity,
-                   subl.girth, subl.axisminor, subl.metdphi, 
-                   subl.ecfM2b1, subl.ecfD2b1, subl.ecfC2b1, subl.ecfN2b2, ak4partFlav.partonFlovor,
-                   subl.pt, subl.eta, subl.phi, subl.energy, subl.rt, subl.mt
-                   ])
+            for chunk in chunks:
+                if index is None:
+                    n_entries = len(chunk)
+                    chunk = chunk.select(preselection_chunk(chunk))
+                else:
+                    # Chunks only hold passing entries; all entries before the next passing one are done
+                    n_read += len(chunk)
+                    n_entries = int(entries[n_read] if n_read < len(entries) else stop) - state['entry']
+                n_total_this += n_entries
+                n_total_all += n_entries
+                state['entry'] += n_entries
+                if len(chunk):
+                    n_presel_this += len(chunk)
+                    n_presel_all += len(chunk)
+                    subl = get_subl_chunk(chunk)
+                    ak4partFlav = part_flavor_chunk(chunk, subl)
+                    X.extend([
+                       subl.ptD, subl.axismajor, subl.multiplicity,
+                       subl.girth, subl.axisminor, subl.metdphi,
+                       subl.ecfM2b1, subl.ecfD2b1, subl.ecfC2b1, subl.ecfN2b2, ak4partFlav.partonFlovor,
+                       subl.pt, subl.eta, subl.phi, subl.energy, subl.rt, subl.mt
+                       ])
+                if chunked_save and len(X) >= chunked_save:
+                    flush()
+                    X = ColumnBuffer(BKG_COLUMNS, dtype)
+                if chunked_save:
+                    state.update(n_total=n_total_this, n_presel=n_presel_this)
+                    if not len(X): write_checkpoint(checkpoint, state)
+            if index is not None and state['entry'] < stop:
+                # No passing entries left
+                n_total_this += stop - state['entry']
+                n_total_all += stop - state['entry']
+                state['entry'] = stop
         except IndexError:
+            print(f'Problem with {rootfile} at entry {state["entry"]}')
             if n_presel_this == 0:
                 print(f'Problem with {rootfile}; no entries, skipping')
                 continue
             else:
                 print(f'Problem with {rootfile}; saving {n_presel_this} good entries')
 
-        outfile = 'data/bkg/{}.npz'.format(dirname_plus_basename(rootfile).replace('.root', ''))
-        print(f'n_total: {n_total_this}; n_presel: {n_presel_this} ({(100.*n_presel_this)/n_total_this:.2f}%)')
-        outdir = osp.abspath(osp.dirname(outfile))
-        if not osp.isdir(outdir): os.makedirs(outdir)
+        print(f'n_total: {n_total_this}; n_presel: {n_presel_this} ({(100.*n_presel_this)/max(n_total_this, 1):.2f}%)')
+        if chunked_save:
+            if len(X): flush()
+            state.update(n_total=n_total_this, n_presel=n_presel_this, done=True)
+            write_checkpoint(checkpoint, state)
+            continue
         print(f'Saving {n_presel_this} entries to {outfile}')
-        np.savez(outfile, X=X)
-
+        save_bkg(
+            outfile, X, columnar,
+            cutflow=dict(n_total=n_total_this, n_presel=n_presel_this), metadata=dict(input=rootfile)
+            )
+        if cache is not None: cache.store(key, outfile)
 
 
 def dirname_plus_basename(fullpath):
@@ -397,10 +1230,593 @@ def make_local(rootfile):
         os.remove(tmpfile)
 
 
-def iter_rootfiles_umd(rootfiles):
-    for rootfile in rootfiles:
-        with make_local(rootfile) as tmpfile:
-            yield tmpfile
+class Profile:
+    """
+    Records wall time, events in and events out per processing stage, plus
+    the peak RSS of the process. Dump to json with `dump`, and merge the
+    records of many jobs with `aggregate_profiles`.
+    """
+    def __init__(self, label=None):
+        self.label = label
+        self.stages = {}
+
+    def add(self, stage, seconds, n_in=0, n_out=0):
+        record = self.stages.setdefault(stage, dict(seconds=0., n_in=0, n_out=0))
+        record['seconds'] += seconds
+        record['n_in'] += int(n_in)
+        record['n_out'] += int(n_out)
+
+    @contextmanager
+    def time(self, stage, n_in=0):
+        """
+        Times the enclosed block. The yielded dict can be used to set the number
+        of events out (default: same as in).
+        """
+        counts = dict(n_out=n_in)
+        t0 = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            self.add(stage, time.perf_counter() - t0, n_in, counts['n_out'])
+
+    def iterate(self, stage, chunks):
+        """
+        Wraps an iterable of chunks, timing how long it takes to get every chunk
+        """
+        chunks = iter(chunks)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                self.add(stage, time.perf_counter() - t0)
+                return
+            self.add(stage, time.perf_counter() - t0, len(chunk), len(chunk))
+            yield chunk
+
+    def merge(self, other):
+        """Adds the stage records of another Profile to this one"""
+        for stage, record in other.stages.items():
+            self.add(stage, record['seconds'], record['n_in'], record['n_out'])
+
+    @staticmethod
+    def peak_rss_mb():
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+    def to_dict(self):
+        return dict(label=self.label, peak_rss_mb=self.peak_rss_mb(), stages=self.stages)
+
+    def dump(self, outfile):
+        with open(outfile, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def report(self):
+        print(f'Profile of {self.label} (peak RSS {self.peak_rss_mb():.0f} MB):')
+        for stage, record in self.stages.items():
+            rate = record['n_in'] / record['seconds'] if record['seconds'] else 0.
+            print(
+                f'  {stage:<14} {record["seconds"]:8.2f}s  {record["n_in"]:>9} in'
+                f'  {record["n_out"]:>9} out  {rate:10.0f} events/s'
+                )
+
+
+def dump_profiles(profiles, outfile):
+    """
+    Dumps the records of many Profiles (e.g. one per input file of a job) to
+    a single json list, so that a job stages out one file
+    """
+    with open(outfile, 'w') as f:
+        json.dump([profile.to_dict() for profile in profiles], f, indent=2)
+
+
+def read_profile_records(records):
+    """
+    Returns a flat list of Profile records from dicts and paths to json dumps
+    of a single record (Profile.dump) or a list of them (dump_profiles)
+    """
+    out = []
+    for record in records:
+        if isinstance(record, str):
+            with open(record) as f: record = json.load(f)
+        out.extend(record if isinstance(record, list) else [record])
+    return out
+
+
+def aggregate_profiles(records, group=lambda label: osp.dirname(str(label))):
+    """
+    Merges Profile records (see read_profile_records) of many jobs.
+    Records are grouped by `group(label)`, by default the directory of the
+    input file, i.e. per sample. Returns a dict group -> merged record, with
+    events_per_sec added per stage.
+    """
+    merged = {}
+    for record in read_profile_records(records):
+        out = merged.setdefault(group(record['label']), dict(n_jobs=0, peak_rss_mb=0., stages={}))
+        out['n_jobs'] += 1
+        out['peak_rss_mb'] = max(out['peak_rss_mb'], record['peak_rss_mb'])
+        for stage, stage_record in record['stages'].items():
+            out_stage = out['stages'].setdefault(stage, dict(seconds=0., n_in=0, n_out=0))
+            for key in ['seconds', 'n_in', 'n_out']:
+                out_stage[key] += stage_record[key]
+    for out in merged.values():
+        for stage_record in out['stages'].values():
+            stage_record['events_per_sec'] = (
+                stage_record['n_in'] / stage_record['seconds'] if stage_record['seconds'] else 0.
+                )
+    return merged
+
+
+def write_columns(outdir, d, metadata=None):
+    """
+    Writes a dict of arrays as a column directory: every array becomes a typed,
+    uncompressed <name>.npy that can be memory-mapped on its own, and
+    metadata.json holds the column names, dtypes and shapes. Scalar values
+    (cut-flow counts) and the `metadata` dict are stored in metadata.json too.
+    """
+    if not osp.isdir(outdir): os.makedirs(outdir)
+    metadata = dict(metadata or {}, columns={}, cutflow={})
+    for key, value in d.items():
+        value = np.asarray(value)
+        if value.ndim == 0:
+            metadata['cutflow'][key] = value.item()
+            continue
+        if value.dtype == object:
+            raise TypeError(f'Column {key} has object dtype; columns must be typed arrays')
+        np.save(osp.join(outdir, key + '.npy'), value)
+        metadata['columns'][key] = dict(dtype=value.dtype.str, shape=list(value.shape))
+    with open(osp.join(outdir, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+
+def read_column_metadata(path):
+    with open(osp.join(path, 'metadata.json')) as f:
+        return json.load(f)
+
+
+def read_columns(path, columns=None, mmap=True):
+    """
+    Reads columns from a column directory written by write_columns. Only the
+    requested columns are opened, and by default they are memory-mapped
+    rather than read.
+    """
+    if columns is None: columns = list(read_column_metadata(path)['columns'])
+    return {
+        column: np.load(osp.join(path, column + '.npy'), mmap_mode='r' if mmap else None)
+        for column in columns
+        }
+
+
+def copy_output(src, dst):
+    """
+    Copies an output file or column directory. Either side may be remote.
+    """
+    if osp.isdir(src):
+        names = os.listdir(src)
+    elif is_remote(src) and not seutils.isfile(src):
+        # Remote column directory: get the metadata first to know the columns
+        copy_output(src + '/metadata.json', osp.join(dst, 'metadata.json'))
+        names = [column + '.npy' for column in read_column_metadata(dst)['columns']]
+    else:
+        if not is_remote(dst) and osp.dirname(dst) and not osp.isdir(osp.dirname(dst)):
+            os.makedirs(osp.dirname(dst))
+        if is_remote(src) or is_remote(dst):
+            seutils.cp(src, dst)
+        else:
+            shutil.copyfile(src, dst)
+        return
+    for name in names:
+        copy_output(src + '/' + name, dst + '/' + name)
+
+
+def file_size(path):
+    """
+    Returns the size of a local or remote file in bytes, or None if unknown
+    """
+    try:
+        return osp.getsize(path) if osp.isfile(path) else seutils.stat(path).size
+    except Exception:
+        return None
+
+
+_checksums = {}
+
+def file_checksum(path):
+    """
+    adler32 checksum of a local file, or None for remote files.
+    Memoized on (path, size, mtime).
+    """
+    if not osp.isfile(path): return None
+    stat = os.stat(path)
+    key = (osp.abspath(path), stat.st_size, stat.st_mtime)
+    if key not in _checksums:
+        checksum = 1
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(16*1024**2), b''):
+                checksum = zlib.adler32(block, checksum)
+        _checksums[key] = f'{checksum:08x}'
+    return _checksums[key]
+
+
+def code_version(*functions):
+    """
+    Hash of the source code of the given functions, to version cached results
+    """
+    sha = hashlib.sha256()
+    for function in functions:
+        sha.update(inspect.getsource(function).encode())
+    return sha.hexdigest()[:16]
+
+
+def model_hash(model):
+    """
+    Hash of a bdt model, given as a path to the model .json or a loaded model.
+    Also takes a dict or list of models.
+    """
+    sha = hashlib.sha256()
+    if isinstance(model, (dict, list, tuple)):
+        items = sorted(model.items()) if isinstance(model, dict) else enumerate(model)
+        for name, m in items:
+            sha.update(f'{name}:{model_hash(m)};'.encode())
+        return sha.hexdigest()[:16]
+    if isinstance(model, str):
+        with open(model, 'rb') as f: sha.update(f.read())
+    else:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            model_json = osp.join(tmpdir, 'model.json')
+            model.save_model(model_json)
+            with open(model_json, 'rb') as f: sha.update(f.read())
+    return sha.hexdigest()[:16]
+
+
+class ResultCache:
+    """
+    Content-addressed cache of output files (or column directories, see
+    write_columns). The key of an output is a hash of
+    the identity of its inputs (path, size and for local files an adler32
+    checksum) and any other components passed to `key` (model hash, code
+    version, branch schema, ...). The cache directory can be local or remote.
+
+    Every lookup is recorded, and write_manifest dumps the hits and misses.
+    """
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        self.manifest = []
+
+    def key(self, rootfiles, **components):
+        if isinstance(rootfiles, str): rootfiles = [rootfiles]
+        identity = dict(
+            inputs = [[rootfile, file_size(rootfile), file_checksum(rootfile)] for rootfile in rootfiles],
+            **components
+            )
+        return hashlib.sha256(json.dumps(identity, sort_keys=True, default=str).encode()).hexdigest()
+
+    def path(self, key, ext='.npz'):
+        return osp.join(self.cachedir, key[:2], key + ext)
+
+    def fetch(self, key, outfile, label=None):
+        """
+        Copies the cached output for key to outfile. Returns False on a cache miss.
+        """
+        cached = self.path(key, osp.splitext(outfile)[1])
+        if is_remote(cached):
+            hit = seutils.isfile(cached) or seutils.isfile(cached + '/metadata.json')
+        else:
+            hit = osp.exists(cached)
+        self.manifest.append(dict(input=label, key=key, output=outfile, status='hit' if hit else 'miss'))
+        if hit:
+            print(f'Cache hit for {label}: {cached} -> {outfile}')
+            copy_output(cached, outfile)
+        return hit
+
+    def store(self, key, outfile):
+        copy_output(outfile, self.path(key, osp.splitext(outfile)[1]))
+
+    @property
+    def hits(self):
+        return [entry for entry in self.manifest if entry['status'] == 'hit']
+
+    @property
+    def misses(self):
+        return [entry for entry in self.manifest if entry['status'] == 'miss']
+
+    def write_manifest(self, outfile='cache_manifest.json'):
+        print(f'Cache: {len(self.hits)} hits, {len(self.misses)} misses; manifest in {outfile}')
+        with open(outfile, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+
+
+def build_preselection_index(rootfile, remote_options=None):
+    """
+    Runs the preselection over all entries of rootfile, reading only the
+    preselection branches. Returns the sorted entry numbers of the passing
+    events and the CutFlowColumn (including 'total').
+    """
+    cutflow = CutFlowColumn()
+    entries = []
+    offset = 0
+    try:
+        for chunk in iter_chunks(rootfile, stages=['preselection'], remote_options=remote_options):
+            cutflow.plus('total', len(chunk))
+            entries.append(offset + np.nonzero(preselection_chunk(chunk, cutflow))[0])
+            offset += len(chunk)
+    except IndexError:
+        print(f'Problem with {rootfile}; index only covers the first {offset} entries')
+    return np.concatenate(entries) if entries else np.zeros(0, np.int64), cutflow
+
+
+class PreselectionIndex:
+    """
+    Persisted per-rootfile index of the entries that pass the preselection,
+    with the cut flow counts and the hash of the preselection code. The first
+    `load` of a rootfile runs the preselection and stores the index in a
+    ResultCache under indexdir (local or remote); later loads only read the
+    index. The key includes the code hash, so a change to the preselection
+    gives a new index.
+
+    Indices are keyed on the rootfile as named by the caller (the remote
+    rootfile for a Prefetcher), not on the file that is read to build it, so
+    the index of a local copy is found again in the next run.
+
+    Use with iter_indexed_chunks to read only the passing entries.
+    """
+    def __init__(self, indexdir, remote_options=None):
+        self.cache = ResultCache(indexdir)
+        self.remote_options = remote_options
+        self.code = code_version(
+            build_preselection_index, preselection_chunk, calculate_kinematics, CutFlowColumn
+            )
+
+    def load(self, rootfile, input_rootfile=None):
+        """
+        Returns the passing entries and the CutFlowColumn of rootfile. If the
+        index has to be built, input_rootfile (e.g. a local copy) is read
+        instead of rootfile.
+        """
+        key = self.cache.key(rootfile, code=self.code, schema=get_branches('preselection'))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            indexfile = osp.join(tmpdir, 'index.npz')
+            if not self.cache.fetch(key, indexfile, rootfile):
+                entries, cutflow = build_preselection_index(input_rootfile or rootfile, self.remote_options)
+                np.savez(indexfile, entries=entries, code=np.array(self.code), **cutflow.counts)
+                self.cache.store(key, indexfile)
+                return entries, cutflow
+            with np.load(indexfile) as f:
+                if str(f['code']) != self.code:
+                    raise ValueError(f'Index for {rootfile} was made with preselection code {f["code"]}, not {self.code}')
+                entries = f['entries']
+                cutflow = CutFlowColumn()
+                cutflow.counts = {key: int(f[key]) for key in f.files if key not in ('entries', 'code')}
+        return entries, cutflow
+
+
+class Prefetcher:
+    """
+    Iterates over remote rootfiles, yielding (rootfile, local copy) pairs.
+    Copies are made in background threads ahead of processing, so transfers
+    overlap with the processing of the current file. At most `n_prefetch` files
+    are copied ahead, and no new copy is started while the local copies take up
+    more than `max_gb` GB. A local copy is removed as soon as the next file is
+    requested. Every copy gets its own temporary directory in `tmpdir`, so
+    inputs with the same name (the same sample in different production
+    directories) never share a local path; within it, the copy keeps the
+    <sample>/<file>.root layout (see dirname_plus_basename).
+
+    A failed copy does not stop the files after it from being processed, but
+    once all other files are done a RuntimeError lists the failed ones (also
+    kept in `failed`), so a run never finishes with inputs silently missing.
+
+    `wait_time` is the total time the consumer waited on transfers.
+    """
+    def __init__(self, rootfiles, n_prefetch=2, max_gb=None, tmpdir='tmp'):
+        self.rootfiles = rootfiles
+        self.n_prefetch = n_prefetch
+        self.max_gb = max_gb
+        self.tmpdir = tmpdir
+        self.wait_time = 0.
+        self.n_done = 0
+        self.failed = []
+
+    def copy(self, rootfile, tmpfile):
+        tmpdir = osp.dirname(tmpfile)
+        if tmpdir and not osp.isdir(tmpdir): os.makedirs(tmpdir, exist_ok=True)
+        seutils.cp(rootfile, tmpfile)
+
+    def disk_usage(self, tmpfiles):
+        return sum(osp.getsize(f) for f in tmpfiles if osp.isfile(f))
+
+    def remove(self, tmpfile):
+        """Removes a local copy and its temporary directory"""
+        shutil.rmtree(osp.dirname(osp.dirname(tmpfile)), ignore_errors=True)
+
+    def __iter__(self):
+        rootfiles = iter(self.rootfiles)
+        queue = collections.deque()
+        current = []
+        def fill():
+            while len(queue) < self.n_prefetch:
+                if self.max_gb is not None and self.disk_usage(current + [q[1] for q in queue]) > self.max_gb * 1e9:
+                    return
+                try:
+                    rootfile = next(rootfiles)
+                except StopIteration:
+                    return
+                if not osp.isdir(self.tmpdir): os.makedirs(self.tmpdir, exist_ok=True)
+                tmpfile = osp.join(tempfile.mkdtemp(dir=self.tmpdir), dirname_plus_basename(rootfile))
+                queue.append((rootfile, tmpfile, executor.submit(self.copy, rootfile, tmpfile)))
+
+        executor = concurrent.futures.ThreadPoolExecutor(self.n_prefetch)
+        try:
+            fill()
+            while queue:
+                rootfile, tmpfile, future = queue.popleft()
+                t0 = time.time()
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f'Failed to copy {rootfile}: {e}')
+                    self.failed.append(rootfile)
+                    self.remove(tmpfile)
+                    fill()
+                    continue
+                finally:
+                    self.wait_time += time.time() - t0
+                current.append(tmpfile)
+                fill()
+                try:
+                    yield rootfile, tmpfile
+                finally:
+                    print(f'Removing {tmpfile}')
+                    self.remove(tmpfile)
+                    current.pop()
+                    self.n_done += 1
+                # Copies may have been held back by max_gb
+                fill()
+            if self.failed:
+                raise RuntimeError(
+                    f'Failed to copy {len(self.failed)} rootfile(s): ' + ', '.join(self.failed)
+                    )
+        finally:
+            # Consumer stopped early: wait for running copies and clean them up
+            for rootfile, tmpfile, future in queue:
+                future.cancel()
+            executor.shutdown(wait=True)
+            for rootfile, tmpfile, future in queue:
+                self.remove(tmpfile)
+            print(f'Processed {self.n_done} files; waited {self.wait_time:.1f}s on transfers')
+
+
+def iter_rootfiles_umd(rootfiles, n_prefetch=2, max_gb=None):
+    for rootfile, tmpfile in Prefetcher(rootfiles, n_prefetch, max_gb):
+        yield tmpfile
+
+
+def iter_inputs(rootfiles):
+    """
+    Yields (rootfile, input_rootfile) pairs: rootfile labels the outputs and
+    cache keys, input_rootfile is the file that is read. A Prefetcher yields
+    the remote rootfile with its local copy; other rootfiles are read as is.
+    """
+    if isinstance(rootfiles, Prefetcher):
+        yield from rootfiles
+    else:
+        for rootfile in uptools.format_rootfiles(rootfiles):
+            yield rootfile, rootfile
+
+
+# Rough processing rate in input bytes per second of wall time, for samples
+# without a measured rate (see measure_rates)
+DEFAULT_RATE = 2.*1024**2
+# Files per job when no file sizes are known at all (see plan_jobs)
+DEFAULT_FILES_PER_JOB = 25
+
+def sample_of(rootfile):
+    """The sample a rootfile belongs to: its directory"""
+    return osp.dirname(rootfile)
+
+
+def file_sizes(rootfiles, n_threads=8):
+    """
+    Returns a dict rootfile -> size in bytes (None if unknown). Remote files
+    are stat'ed in parallel threads.
+    """
+    rootfiles = list(rootfiles)
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+        return dict(zip(rootfiles, executor.map(file_size, rootfiles)))
+
+
+def measure_rates(records, sizes=None):
+    """
+    Processing rates in input bytes per second of wall time per sample, from
+    Profile records (see read_profile_records) of earlier jobs. The label of
+    every record must be its input rootfile. `sizes` is a dict
+    rootfile -> size; missing sizes are looked up.
+    """
+    records = read_profile_records(records)
+    sizes = dict(sizes or {})
+    missing = [r['label'] for r in records if r['label'] not in sizes]
+    if missing: sizes.update(file_sizes(missing))
+    totals = {}
+    for record in records:
+        size = sizes.get(record['label'])
+        if not size: continue
+        total = totals.setdefault(sample_of(record['label']), [0., 0.])
+        total[0] += size
+        total[1] += sum(stage['seconds'] for stage in record['stages'].values())
+    return {sample: n_bytes / seconds for sample, (n_bytes, seconds) in totals.items() if seconds}
+
+
+def plan_jobs(rootfiles, target_seconds=3600., rates=None, sizes=None, max_files=None, manifest=None):
+    """
+    Packs rootfiles into jobs of about target_seconds of wall time each.
+
+    The wall time of a file is estimated as its size over the rate of its
+    sample (`rates`: dict sample -> bytes/s, see measure_rates; DEFAULT_RATE
+    otherwise). Files are packed largest first into the first job that still
+    has room (first-fit decreasing); files estimated to take longer than
+    target_seconds get a job of their own. max_files caps the number of
+    files per job. Files of unknown size count as the median known size; if
+    no size is known at all, the rootfiles are simply split in jobs of
+    max_files (or DEFAULT_FILES_PER_JOB) files.
+
+    Returns a list of jobs, dicts with the rootfiles, the total size and the
+    estimated seconds. If manifest is given, the plan is saved there; if the
+    manifest already exists and covers the same rootfiles, that plan is
+    reused.
+    """
+    rootfiles = list(rootfiles)
+    if manifest and osp.isfile(manifest):
+        with open(manifest) as f:
+            plan = json.load(f)
+        if sorted(f for job in plan['jobs'] for f in job['rootfiles']) == sorted(rootfiles):
+            print(f'Reusing plan of {len(plan["jobs"])} jobs from {manifest}')
+            return plan['jobs']
+        print(f'Rootfiles changed since {manifest}; making a new plan')
+    rates = rates or {}
+    sizes = dict(sizes or {})
+    missing = [f for f in rootfiles if f not in sizes]
+    if missing: sizes.update(file_sizes(missing))
+    known = [sizes[f] for f in rootfiles if sizes[f]]
+    if not known:
+        n = max_files or DEFAULT_FILES_PER_JOB
+        print(f'No file sizes known; splitting {len(rootfiles)} rootfiles in jobs of {n} files')
+        jobs = [
+            dict(rootfiles=rootfiles[i:i+n], bytes=0, seconds=0.)
+            for i in range(0, len(rootfiles), n)
+            ]
+        if manifest: write_plan(manifest, target_seconds, rates, jobs)
+        return jobs
+    # Files of unknown size count as the median size
+    median = float(np.median(known))
+    seconds = {
+        f : (sizes[f] or median) / rates.get(sample_of(f), DEFAULT_RATE)
+        for f in rootfiles
+        }
+    jobs = []
+    for rootfile in sorted(rootfiles, key=lambda f: seconds[f], reverse=True):
+        for job in jobs:
+            if job['seconds'] + seconds[rootfile] <= target_seconds and (
+                max_files is None or len(job['rootfiles']) < max_files
+                ):
+                break
+        else:
+            job = dict(rootfiles=[], bytes=0, seconds=0.)
+            jobs.append(job)
+        job['rootfiles'].append(rootfile)
+        job['bytes'] += sizes[rootfile] or 0
+        job['seconds'] += seconds[rootfile]
+    print(
+        f'Packed {len(rootfiles)} rootfiles in {len(jobs)} jobs;'
+        f' longest job {max((j["seconds"] for j in jobs), default=0.)/60.:.0f} min'
+        )
+    if manifest: write_plan(manifest, target_seconds, rates, jobs)
+    return jobs
+
+
+def write_plan(manifest, target_seconds, rates, jobs):
+    if osp.dirname(manifest) and not osp.isdir(osp.dirname(manifest)): os.makedirs(osp.dirname(manifest))
+    with open(manifest, 'w') as f:
+        json.dump(dict(target_seconds=target_seconds, rates=rates, jobs=jobs), f, indent=2)
 
 
 def main():
@@ -414,7 +1830,7 @@ def main():
             )
     elif args.signal:
         process_signal(
-            iter_rootfiles_umd(
+            Prefetcher(
                 seutils.ls_wildcard(
                     'gsiftp://hepcms-gridftp.umd.edu//mnt/hadoop/cms/store/user/snabili/BKG/sig_mz250_rinv0p3_mDark20_Mar31/*.root'
                     )
@@ -423,7 +1839,7 @@ def main():
             )
     elif args.bkg:
         process_bkg(
-            iter_rootfiles_umd(seutils.ls_wildcard(
+            Prefetcher(seutils.ls_wildcard(
                 'gsiftp://hepcms-gridftp.umd.edu//mnt/hadoop/cms/store/user/snabili/BKG/bkg_May04_year2018/*/*.root'
                 )),
             )
@@ -1,6 +1,7 @@
 """# submit
 htcondor('request_memory', '4096MB')
 import seutils, os.path as osp, itertools
+from dataset import plan_jobs
 
 print('Compiling list of rootfiles...')
 # qcd 2018 
@@ -24,47 +25,106 @@ bkg_rootfiles = [ seutils.ls_wildcard(d + '/*.root') for d in [
     ]]
 bkg_rootfiles = list(itertools.chain.from_iterable(bkg_rootfiles))
 
-bdt_json = 'svjbdt_girthreweight_Jan06.json' #girth re-weight
+# Same models as in signal_postbdt.py, evaluated in the same pass and stored as
+# score_<name>; the girth re-weighted model is stored as 'score'
+bdt_jsons = dict(
+    score = 'svjbdt_girthreweight_Jan06.json', # girth re-weight
+    ptreweight = 'svjbdt_ptreweight_Jan06.json',
+    massreweight = 'svjbdt_massreweight_Jan06.json',
+    nominal = 'svjbdt_Jan06.json',
+    )
 
 
 #print("background rootfiles are: ", bkg_rootfiles)
 
-def submit_chunk(chunk):
+def submit_chunk(chunk, job_index):
     submit(
         rootfiles=chunk,
-        bdt_json=bdt_json,
+        job_index=job_index,
+        bdt_jsons=bdt_jsons,
         run_env='condapack:root://cmseos.fnal.gov//store/user/klijnsma/conda-svj-bdt.tar.gz',
-        transfer_files=['combine_hists.py', 'dataset.py', bdt_json],
+        transfer_files=['combine_hists.py', 'dataset.py'] + list(bdt_jsons.values()),
+        # Stream the needed branches from the remote input; False copies the full input first
+        stream_remote=True,
+        # The bdt is evaluated on batches of at least batch_size events across
+        # the input files, with nthread inference threads
+        batch_size=100000,
+        nthread=1,
+        # Write all rootfiles of a job to a single output, staged out once
+        aggregate=True,
         )
 
 
-for chunk in qondor.utils.chunkify(bkg_rootfiles, chunksize=25):
-    submit_chunk(chunk)
+# Pack the files into jobs of about 2 hours, by file size. Pass
+# rates=measure_rates(<profiles/job*.json of earlier jobs>) to use measured rates
+# per sample. The plan is saved to the manifest and reused on resubmission.
+for job_index, job in enumerate(plan_jobs(bkg_rootfiles, target_seconds=2*3600., manifest='plans/qcd_postbdt.json')):
+    submit_chunk(job['rootfiles'], job_index)
 """# endsubmit
 
 import qondor, seutils
-from combine_hists import dump_score_npz
-import xgboost as xgb
+from combine_hists import iter_scores, save_scores, dump_scores_aggregated, load_model
+from dataset import Prefetcher, dump_profiles
 import os.path as osp, os
 
-model = xgb.XGBClassifier()
-model.load_model(qondor.scope.bdt_json)
+# Load the models once; {name: model} gives a score_<name> column per model
+model = {name : load_model(bdt_json) for name, bdt_json in qondor.scope.bdt_jsons.items()}
 
-for rootfile in qondor.scope.rootfiles:
+if qondor.scope.stream_remote:
+    # Read only the needed branches directly from the remote input
+    inputs = ((rootfile, rootfile) for rootfile in qondor.scope.rootfiles)
+else:
+    # Copies the next input files in the background while the current one is processed
+    inputs = Prefetcher(qondor.scope.rootfiles, n_prefetch=2)
+
+# One Profile per input file, labelled with the rootfile, for
+# dataset.measure_rates when planning the next submission
+profiles = []
+scores = iter_scores(
+    inputs, model, batch_size=qondor.scope.batch_size, nthread=qondor.scope.nthread,
+    profiles=profiles
+    )
+
+outprefix = (
+    'gsiftp://hepcms-gridftp.umd.edu//mnt/hadoop/cms/store/user/snabili/NPZfiles_PostBDT/BDT_QCD_03152022_'
+    #'gsiftp://hepcms-gridftp.umd.edu//mnt/hadoop/cms/store/user/snabili/NPZfiles_PostBDT/BDT_QCD_03142022_dataStudy_'
+    )
+
+if qondor.scope.aggregate:
+    # One output for all rootfiles, with the source rootfile of every row
+    # recorded (see dump_scores_aggregated), and a single stage-out. Staged
+    # out even if no event passed, so the events read are still counted
     try:
-        seutils.cp(rootfile, 'in.root')
-        dump_score_npz('in.root', model, 'out.npz')
+        dump_scores_aggregated(scores, 'out.npz', model)
         seutils.cp(
            'out.npz',
-           'gsiftp://hepcms-gridftp.umd.edu//mnt/hadoop/cms/store/user/snabili/NPZfiles_PostBDT/BDT_QCD_03152022_'
-           #'gsiftp://hepcms-gridftp.umd.edu//mnt/hadoop/cms/store/user/snabili/NPZfiles_PostBDT/BDT_QCD_03142022_dataStudy_'
-           + '/'.join(rootfile.split('/')[-3:]).replace('.root', '.npz'),
-           implementation='gfal', env=qondor.BARE_ENV),
-
-    except Exception as e:
-        print('Failed for rootfile ' + rootfile + ':')
-        print(e)
-        
+           outprefix + f'jobs/job{qondor.scope.job_index}.npz',
+           implementation='gfal', env=qondor.BARE_ENV)
     finally:
         if osp.isfile('out.npz'): os.remove('out.npz')
-        if osp.isfile('in.root'): os.remove('in.root')
+
+else:
+    for rootfile, d in scores:
+        if 'mt' not in d:
+            print('No events passed for rootfile ' + rootfile + ', skipping')
+            continue
+        try:
+            save_scores(d, 'out.npz', rootfile, model)
+            seutils.cp(
+               'out.npz',
+               outprefix + '/'.join(rootfile.split('/')[-3:]).replace('.root', '.npz'),
+               implementation='gfal', env=qondor.BARE_ENV),
+
+        except Exception as e:
+            print('Failed for rootfile ' + rootfile + ':')
+            print(e)
+        
+        finally:
+            if osp.isfile('out.npz'): os.remove('out.npz')
+
+# Stage out the per-file profiles of the job in a single file
+dump_profiles(profiles, 'profiles.json')
+seutils.cp(
+   'profiles.json',
+   outprefix + f'profiles/job{qondor.scope.job_index}.json',
+   implementation='gfal', env=qondor.BARE_ENV)